@@ -1,7 +1,12 @@
 import sys
 import ctypes
+import multiprocessing
 import os
 import asyncio
+from pathlib import Path
+from typing import AsyncIterator, Iterable, Iterator
+
+import pandas as pd
 from tqdm import tqdm
 
 # Import Gooey
@@ -12,6 +17,11 @@ from utils.merger import DataManager
 from utils.preprocessor import Preprocessor
 from utils.chatprocessor import ChatProcessor
 from utils.ai import get_analyzer
+from utils.cache import ResponseCache
+from utils.journal import ResultJournal
+from utils.pipeline import StagePipeline
+from utils.sink import open_sink
+from utils.watermark import WatermarkStore
 
 # Ensure the event loop policy is set for Windows if needed
 if sys.platform.startswith("win"):
@@ -76,6 +86,36 @@ def main():
         widget="DirChooser",
     )
 
+    merger_group.add_argument(
+        "--full_merge",
+        action="store_true",
+        help="Ignore the merge manifest and re-merge every group from its sources",
+        widget="CheckBox",
+    )
+
+    merger_group.add_argument(
+        "--merge_workers",
+        type=int,
+        default=1,
+        help="Worker processes merging groups in parallel (1 merges in this process)",
+    )
+
+    merger_group.add_argument(
+        "--merge_format",
+        type=str,
+        choices=["csv", "parquet"],
+        default="csv",
+        help="File format of merged groups (Parquet loads faster in the later stages)",
+        widget="Dropdown",
+    )
+
+    merger_group.add_argument(
+        "--merge_chunk_rows",
+        type=int,
+        default=0,
+        help="Merge groups out of core in chunks of this many rows to bound memory (0 merges each group in memory)",
+    )
+
     # --- Tab 2: File Paths & Directories ---
     organizer_group = parser.add_argument_group(
         "CSV Organizer: organize chat CSV files by group natures in reference file",
@@ -98,6 +138,15 @@ def main():
         widget="DirChooser",
     )
 
+    organizer_group.add_argument(
+        "--organize_mode",
+        type=str,
+        choices=["copy", "link", "manifest"],
+        default="copy",
+        help="Copy files into nature folders, hardlink them, or only write a nature manifest read from the merge folder",
+        widget="Dropdown",
+    )
+
     # --- Tab 3: AI & Processing Settings ---
     ai_group = parser.add_argument_group(
         "Chat Processer: tag brand keywords and analyze message sentiment with power of AI",
@@ -116,7 +165,7 @@ def main():
         "--output_file",
         type=str,
         default="./data/final_analysis.xlsx",
-        help="Filename for the final Excel output",
+        help="Filename for the final output (.xlsx, .csv, .jsonl or .parquet)",
         widget="FileSaver",
     )
 
@@ -149,6 +198,20 @@ def main():
         "--max_rate", type=int, default=400, help="Maximum requests per time period"
     )
 
+    ai_group.add_argument(
+        "--no_adaptive",
+        action="store_true",
+        help="Keep concurrency and rate fixed instead of adapting them to 429s and latency",
+        widget="CheckBox",
+    )
+
+    ai_group.add_argument(
+        "--workers",
+        type=int,
+        default=400,
+        help="Number of workers pulling LLM requests from the queue",
+    )
+
     ai_group.add_argument(
         "--time_period",
         type=int,
@@ -156,6 +219,48 @@ def main():
         help="Time period for rate limiting (in seconds)",
     )
 
+    ai_group.add_argument(
+        "--batch_size",
+        type=int,
+        default=1,
+        help="Messages packed into one LLM request (1 disables batching)",
+    )
+
+    ai_group.add_argument(
+        "--batch_max_tokens",
+        type=int,
+        default=8000,
+        help="Estimated token ceiling of the messages and answers in one batched request",
+    )
+
+    ai_group.add_argument(
+        "--multi_target",
+        action="store_true",
+        help="Send a message mentioning several brands once and get a sentiment per brand (unbatched mode only)",
+        widget="CheckBox",
+    )
+
+    ai_group.add_argument(
+        "--concurrent_sheets",
+        action="store_true",
+        help="Tag all sheets first and share one LLM request queue across them (not with --pipeline)",
+        widget="CheckBox",
+    )
+
+    ai_group.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="Organize, load, tag and analyze each group as soon as it is merged, one sheet per group; duplicate prompts are only collapsed within a group",
+        widget="CheckBox",
+    )
+
+    ai_group.add_argument(
+        "--pipeline_sheets",
+        type=int,
+        default=2,
+        help="Groups analyzed at the same time in pipeline mode",
+    )
+
     ai_group.add_argument(
         "--message_col",
         type=str,
@@ -163,7 +268,133 @@ def main():
         help="Column name in CSV containing the message text",
     )
 
+    ai_group.add_argument(
+        "--long_output",
+        action="store_true",
+        help="Write one row per keyword hit (Header, Sentiment, Reason) instead of one column per brand header; messages with no keyword hits are left out",
+        widget="CheckBox",
+    )
+
+    ai_group.add_argument(
+        "--compact",
+        action="store_true",
+        help="Hold loaded chats in compact dtypes (categoricals, Arrow strings) to cut memory use",
+        widget="CheckBox",
+    )
+
+    ai_group.add_argument(
+        "--chunk_rows",
+        type=int,
+        default=0,
+        help="Load and analyze chats in chunks of at most this many rows (0 = one whole sheet per nature, not with --pipeline)",
+    )
+
+    ai_group.add_argument(
+        "--load_workers",
+        type=int,
+        default=1,
+        help="Chat files parsed and validated in parallel per nature folder",
+    )
+
+    ai_group.add_argument(
+        "--load_executor",
+        type=str,
+        choices=["process", "thread"],
+        default="process",
+        help="Pool used by --load_workers: processes scale CPU-bound parsing, threads avoid start-up cost",
+        widget="Dropdown",
+    )
+
+    ai_group.add_argument(
+        "--validation",
+        type=str,
+        choices=["full", "once", "sampled", "schema"],
+        default="once",
+        help="Chat file validation: full (per file and after concat), once per file, sampled rows of large files, or schema only",
+        widget="Dropdown",
+    )
+
+    ai_group.add_argument(
+        "--validation_sample_rows",
+        type=int,
+        default=10_000,
+        help="Rows checked per file by the sampled validation policy",
+    )
+
+    ai_group.add_argument(
+        "--journal_file",
+        type=str,
+        default="sentiment_journal.jsonl",
+        help="Filename of the journal of completed LLM results (relative to base path)",
+    )
+
+    ai_group.add_argument(
+        "--resume",
+        action="store_true",
+        help="Reload the journal of an interrupted run and only send the remaining rows",
+        widget="CheckBox",
+    )
+
+    ai_group.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only analyze rows newer than each group's watermark and reuse the previous output for the rest",
+        widget="CheckBox",
+    )
+
+    ai_group.add_argument(
+        "--watermark_file",
+        type=str,
+        default="watermarks.json",
+        help="Filename of the per-group watermarks of the last completed run (relative to base path)",
+    )
+
+    cache_group = parser.add_argument_group(
+        "LLM Response Cache: reuse answers for messages analyzed in previous runs",
+        "Configure the on-disk cache of LLM responses stored under the base path",
+    )
+
+    cache_group.add_argument(
+        "--cache_file",
+        type=str,
+        default="llm_cache.sqlite",
+        help="Filename of the SQLite response cache (relative to base path)",
+    )
+
+    cache_group.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="Bypass the response cache and send every message to the LLM",
+        widget="CheckBox",
+    )
+
+    cache_group.add_argument(
+        "--clear_cache",
+        action="store_true",
+        help="Delete all cached responses before processing",
+        widget="CheckBox",
+    )
+
+    cache_group.add_argument(
+        "--cache_max_entries",
+        type=int,
+        default=1_000_000,
+        help="Maximum number of cached responses kept (oldest are evicted first)",
+    )
+
+    cache_group.add_argument(
+        "--cache_max_age_days",
+        type=float,
+        default=90,
+        help="Cached responses older than this are ignored and evicted",
+    )
+
     args = parser.parse_args()
+    if args.pipeline and (args.chunk_rows or args.concurrent_sheets):
+        # the pipeline analyzes whole groups, each as soon as it is loaded
+        parser.error(
+            "--pipeline cannot be combined with --chunk_rows or --concurrent_sheets"
+        )
 
     # Run the async logic
     try:
@@ -186,33 +417,67 @@ async def run_processing(args):
     print("Initializing Data Manager...")
     dm = DataManager(base_path=args.base_path)
 
-    # 2. Merge Files
-    print(f"Merging files from {args.merge_src} to {args.merge_dst}...")
-    dm.merge_csv_files(src=args.merge_src, dst=args.merge_dst)
+    if args.pipeline:
+        # merged groups are organized and loaded while processing
+        print("Pipeline mode: groups are analyzed as soon as they are merged...")
+    else:
+        # 2. Merge Files
+        print(f"Merging files from {args.merge_src} to {args.merge_dst}...")
+        dm.merge_csv_files(
+            src=args.merge_src,
+            dst=args.merge_dst,
+            full=args.full_merge,
+            workers=args.merge_workers,
+            fmt=args.merge_format,
+            chunk_rows=args.merge_chunk_rows or None,
+        )
 
-    # 3. Organize by Nature
-    print(f"Organizing by nature into {args.natures_dst}...")
-    dm.organize_csv_by_nature(
-        src=args.merge_dst, dst=args.natures_dst, group_nature=args.group_info_file
-    )
+        # 3. Organize by Nature
+        print(f"Organizing by nature into {args.natures_dst}...")
+        dm.organize_csv_by_nature(
+            src=args.merge_dst,
+            dst=args.natures_dst,
+            group_nature=args.group_info_file,
+            mode=args.organize_mode,
+        )
 
     # 4. Initialize Preprocessor
     print("Initializing Preprocessor...")
-    pre = Preprocessor(base_path=args.base_path)
+    pre = Preprocessor(
+        base_path=args.base_path,
+        compact=args.compact,
+        validation=args.validation,
+        sample_rows=args.validation_sample_rows,
+        load_workers=args.load_workers,
+        load_executor=args.load_executor,
+    )
 
     # 5. Load Keywords
     print(f"Loading keywords from {args.keyword_file}...")
-    keyword_df = pre.get_keyword_df(file_path=args.keyword_file)
+    keyword_index = pre.get_keyword_index(file_path=args.keyword_file)
 
-    # 6. Load Chat Dataframes
-    print("Loading chat dataframes...")
-    chats = pre.get_chat_df_dict(chat_folder=args.natures_dst)
+    # 6. List Chat Sheets, they are loaded one at a time while processing
+    sheet_names = [] if args.pipeline else pre.chat_sheet_names(args.natures_dst)
 
-    if not chats:
+    if not sheet_names and not args.pipeline:
         print("No chat files found to process.")
         return
 
     # 7. Initialize AI Analyzer
+    cache = None
+    if args.clear_cache or not args.no_cache:
+        cache = ResponseCache(
+            os.path.join(args.base_path, args.cache_file),
+            max_entries=args.cache_max_entries,
+            max_age_days=args.cache_max_age_days,
+        )
+        if args.clear_cache:
+            print("Clearing LLM response cache...")
+            cache.clear()
+        if args.no_cache:
+            cache.close()
+            cache = None
+
     print(f"Initializing AI Analyzer ({args.provider} - {args.model})...")
     analyzer = get_analyzer(
         provider_name=args.provider,
@@ -220,49 +485,257 @@ async def run_processing(args):
         max_concurrent_task=args.max_concurrent,
         max_rate=args.max_rate,
         time_period=args.time_period,
+        cache=cache,
+        batch_size=args.batch_size,
+        batch_max_tokens=args.batch_max_tokens,
+        multi_target=args.multi_target,
+        adaptive=not args.no_adaptive,
     )
 
     # 8. Initialize ChatProcessor
-    if keyword_df is not None:
-        c = ChatProcessor(keyword_df=keyword_df, analyzer=analyzer)
+    if keyword_index is not None:
+        journal = ResultJournal(
+            os.path.join(args.base_path, args.journal_file), resume=args.resume
+        )
+        if args.resume:
+            print(f"Resuming with {len(journal.answered)} journaled results...")
+        elif journal.rotated is not None:
+            print(f"Previous journal kept as {journal.rotated}")
 
-        # 9. Process Chats
-        print(f"Processing {len(chats)} chat groups...")
+        final_path = os.path.join(args.base_path, args.output_file)
+        previous = None
+        if args.incremental and args.long_output:
+            print("Incremental analysis needs the wide output, analyzing all rows.")
+        elif args.incremental:
+            print(f"Loading previous analysis from {final_path}...")
+            previous = WatermarkStore.read_output(final_path)
+        watermarks = WatermarkStore(
+            os.path.join(args.base_path, args.watermark_file),
+            keyword_index,
+            previous=previous,
+        )
+        if previous is not None and not watermarks.marks:
+            print("No usable watermarks found, analyzing all rows.")
+
+        c = ChatProcessor(
+            keyword_df=keyword_index,
+            analyzer=analyzer,
+            workers=args.workers,
+            journal=journal,
+            watermarks=watermarks,
+            wide=not args.long_output,
+        )
 
-        processed_dfs = []
+        # 9. Process Chats
+        chunks = None
+        if args.pipeline:
+            sheets = pipeline_sheets(args, dm, pre, c)
+        else:
+            print(f"Processing {len(sheet_names)} chat groups...")
+            chats = pre.iter_chat_dfs(
+                chat_folder=args.natures_dst, chunk_rows=args.chunk_rows or None
+            )
+            if args.chunk_rows:
+                chunks = ChunkProgress()
+                chats = chunks.track(chats)
+            sheets = process_sheets(c, chats, args.concurrent_sheets)
 
         # We use a manual counter for Gooey progress bar compatibility
-        total_items = len(chats)
-        current_item = 0
+        total_items = len(pipeline_groups(args) if args.pipeline else sheet_names)
+        finished = 0
+        shown = 0
+
+        def show_progress() -> None:
+            nonlocal shown
+            done = finished if chunks is None else chunks.done
+            progress_percent = int((done / total_items) * 100)
+            if progress_percent != shown:
+                shown = progress_percent
+                print(f"Progress: {progress_percent}%")
+
+        # 10. Save each sheet as it finishes
+        print(f"Writing analysis to {final_path} as sheets finish...")
+        with open_sink(final_path, sheet_per_name=False) as sink:
+            async for sheet, df in sheets:
+                print(f"Finished sheet: {sheet}")
+                sink.write(sheet, df)
+                if not args.long_output:
+                    watermarks.advance(df)
+
+                # Update Progress for Gooey
+                finished += 1
+                if chunks is not None:
+                    chunks.finish(sheet)
+                if total_items:
+                    show_progress()
+                sys.stdout.flush()  # Ensure Gooey catches the print immediately
+
+        if chunks is not None and total_items:
+            # the last sheet is only known to be complete once loading ended
+            show_progress()
+
+        if sink.rows:
+            # only a saved output can back the watermarks of the next run
+            watermarks.save()
+            print(f"Success! Processing complete, {sink.rows} rows written.")
+        else:
+            print("Warning: No data was processed.")
 
-        for sheet, chat in chats.items():
-            print(f"Processing sheet: {sheet}")
+        print(f"Duplicate prompts collapsed: {c.collapsed_calls} LLM calls saved")
+        if watermarks.reused:
+            print(f"Rows reused from the previous output: {watermarks.reused}")
+        print(f"LLM limits at end of run: {analyzer.provider.limits}")
+        if c.failures:
+            failures = ", ".join(f"{k}: {v}" for k, v in c.failures.items())
+            print(f"Failed rows (marked FAILED) by error class: {failures}")
+        if analyzer.provider.breaker.trips:
+            print(f"Circuit breaker opened {analyzer.provider.breaker.trips} times")
+        journal.close()
 
-            # Note: Ensure you updated ChatProcessor to accept message_col if you added that arg
-            # If not, remove `message_col=args.message_col` below
-            df = await c.process_chat_df(chat)
+    if cache is not None:
+        print(cache.summary())
+        cache.close()
 
-            processed_dfs.append(df)
 
-            # Update Progress for Gooey
-            current_item += 1
-            progress_percent = int((current_item / total_items) * 100)
-            print(f"Progress: {progress_percent}%")
-            sys.stdout.flush()  # Ensure Gooey catches the print immediately
+class ChunkProgress:
+    """
+    Counts a sheet loaded in "<sheet>#<n>" chunks as done only once the
+    loader has moved past it and every chunk loaded for it is written.
+    """
 
-        # 10. Save Final Result
-        final_path = os.path.join(args.base_path, args.output_file)
-        print(f"Saving final merged analysis to {final_path}...")
+    def __init__(self) -> None:
+        # sheet -> chunks loaded / written
+        self.loaded: dict[str, int] = {}
+        self.finished: dict[str, int] = {}
+        self.exhausted = False
+
+    def track(
+        self, chats: Iterable[tuple[str, pd.DataFrame]]
+    ) -> Iterator[tuple[str, pd.DataFrame]]:
+        for name, chat in chats:
+            sheet = name.rpartition("#")[0]
+            self.loaded[sheet] = self.loaded.get(sheet, 0) + 1
+            yield name, chat
+        self.exhausted = True
+
+    def finish(self, name: str) -> None:
+        sheet = name.rpartition("#")[0]
+        self.finished[sheet] = self.finished.get(sheet, 0) + 1
+
+    @property
+    def done(self) -> int:
+        sheets = list(self.loaded)
+        if not self.exhausted:
+            # the sheet being loaded may still get more chunks
+            sheets = sheets[:-1]
+        return sum(self.finished.get(s, 0) == self.loaded[s] for s in sheets)
+
+
+async def process_sheets(
+    c: ChatProcessor, chats: Iterable[tuple[str, pd.DataFrame]], concurrent: bool
+) -> AsyncIterator[tuple[str, pd.DataFrame]]:
+    """
+    Yields processed sheets, either one after another, the next one loading
+    in a thread while the current one is analyzed, or with the LLM requests
+    of all sheets sharing one scheduler.
+    """
+    if concurrent:
+        async for sheet, df in c.process_chat_dfs(chats):
+            yield sheet, df
+        return
 
-        if processed_dfs:
-            # Concatenate all processed dataframes
-            import pandas as pd
+    chats = iter(chats)
+    loading = asyncio.create_task(asyncio.to_thread(next, chats, None))
+    try:
+        while (item := await loading) is not None:
+            sheet, chat = item
+            loading = asyncio.create_task(asyncio.to_thread(next, chats, None))
+            print(f"Processing sheet: {sheet}")
+            yield sheet, await c.process_chat_df(chat, sheet)
+    finally:
+        # the thread cannot be interrupted, let a pending load finish
+        if not loading.done():
+            await asyncio.gather(loading, return_exceptions=True)
 
-            final_df = pd.concat(processed_dfs, ignore_index=True)
-            final_df.to_excel(final_path, index=False)
-            print("Success! Processing complete.")
-        else:
-            print("Warning: No data was processed.")
+
+def pipeline_groups(args) -> set[str]:
+    """
+    Groups the pipeline analyzes: those in the merge source with a nature.
+    """
+    natures = DataManager.read_natures(args.group_info_file)
+    sources = Path(args.base_path) / args.merge_src
+    return {
+        path.stem
+        for path in sources.rglob("*.csv")
+        if len(natures.get(path.stem, "")) > 1
+    }
+
+
+async def pipeline_sheets(
+    args, dm: DataManager, pre: Preprocessor, c: ChatProcessor
+) -> AsyncIterator[tuple[str, pd.DataFrame]]:
+    """
+    Streams every group through organize, load, tagging and analysis as soon
+    as it is merged, so LLM requests start while other groups are still
+    merging. Each group is its own "<nature>#<group>" sheet, yielded as it
+    finishes. Duplicate prompts are collapsed within a group only; repeats
+    in later groups are answered by the response cache once known.
+    """
+    natures = DataManager.read_natures(args.group_info_file)
+    natures_path = Path(args.base_path) / args.natures_dst
+    if args.organize_mode != "manifest":
+        # a manifest would take precedence over the folders written here
+        (natures_path / DataManager.NATURE_MANIFEST).unlink(missing_ok=True)
+
+    async def organize(outcome):
+        nature = natures.get(outcome.output.stem, "")
+        if len(nature) <= 1 or not outcome.output.exists():
+            return None
+        path = await asyncio.to_thread(
+            dm.place_file, outcome.output, natures_path / nature, args.organize_mode
+        )
+        return nature, path
+
+    async def load(item):
+        nature, path = item
+        sheet = f"{nature}#{path.stem}"
+        chat = await asyncio.to_thread(pre.get_chat_sheet, path, sheet)
+        return None if chat is None else (sheet, chat)
+
+    async def tag(item):
+        sheet, chat = item
+        return sheet, await asyncio.to_thread(c.tag_chat_df, sheet, chat)
+
+    async def analyze(item):
+        sheet, tagged = item
+        print(f"Processing sheet: {sheet}")
+        return [done async for done in c.process_tagged({sheet: tagged})][0]
+
+    merged = dm.iter_merge_csv_files(
+        src=args.merge_src,
+        dst=args.merge_dst,
+        full=args.full_merge,
+        workers=args.merge_workers,
+        fmt=args.merge_format,
+        chunk_rows=args.merge_chunk_rows or None,
+    )
+    pipeline = (
+        StagePipeline(merged, queue_size=args.pipeline_sheets)
+        .stage("organize", organize)
+        .stage("load", load, workers=args.load_workers)
+        .stage("tag", tag)
+        .stage("analyze", analyze, workers=args.pipeline_sheets)
+    )
+    async for sheet, df in pipeline.run():
+        yield sheet, df
+
+    if args.organize_mode == "manifest":
+        dm.organize_csv_by_nature(
+            src=args.merge_dst,
+            dst=args.natures_dst,
+            group_nature=args.group_info_file,
+            mode="manifest",
+        )
 
 
 async def manual() -> None:
@@ -284,12 +757,14 @@ async def manual() -> None:
     if keyword is not None:
         c = ChatProcessor(keyword_df=keyword, analyzer=a)
         for sheet, chat in tqdm(chats.items(), desc=f"Processing chat data"):
-            df = await c.process_chat_df(chat)
+            df = await c.process_chat_df(chat, sheet)
             chats[sheet] = df
             tqdm.write("Processed folder: " + sheet)
         c.save_result(chats, "./data/output.xlsx")
 
 
 if __name__ == "__main__":
+    # merge worker processes re-import this module in frozen Windows builds
+    multiprocessing.freeze_support()
     # Gooey requires the script to be run directly
     main()
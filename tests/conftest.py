@@ -0,0 +1,38 @@
+import json
+
+import pytest
+from openai.types.chat import ChatCompletion
+
+from utils.ai import SentimentAnalyzer
+
+
+class FakeProvider:
+    """
+    Answers every prompt with a fixed sentiment, without network access.
+    """
+
+    model = "fake"
+    limits = "fake"
+
+    async def get_completion_async(self, messages):
+        content = json.dumps({"sentiment": "P", "reason": "ok"})
+        return True, ChatCompletion.model_validate(
+            {
+                "id": "x",
+                "object": "chat.completion",
+                "created": 0,
+                "model": self.model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "message": {"role": "assistant", "content": content},
+                    }
+                ],
+            }
+        )
+
+
+@pytest.fixture
+def analyzer():
+    return SentimentAnalyzer(FakeProvider())
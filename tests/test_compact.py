@@ -0,0 +1,68 @@
+import asyncio
+import json
+
+import pandas as pd
+
+from utils.chatprocessor import ChatProcessor
+from utils.preprocessor import Preprocessor
+from utils.sink import open_sink
+from utils.watermark import WatermarkStore
+
+
+def write_data(base):
+    pd.DataFrame(
+        {
+            "brand": ["a2", "friso"],
+            "product": ["generic", "generic"],
+            "keyword": ["a2", "美素"],
+            "required_product": ["", ""],
+        }
+    ).to_excel(base / "keywords.xlsx", index=False)
+
+    # few distinct dates and times over many rows, so they become categoricals
+    folder = base / "chats" / "mum"
+    folder.mkdir(parents=True)
+    for group in range(2):
+        pd.DataFrame(
+            {
+                "Date1": "",
+                "Date2": [f"{i % 3 + 1:02d}/01/2024" for i in range(120)],
+                "Time": [f"10:0{i % 4}:00" for i in range(120)],
+                "userPhone": [f"852{group}{i}" for i in range(120)],
+                "quotedMessage": "",
+                "messageBody": ["a2 good", "美素 ok", "hello"] * 40,
+                "mediaType": "",
+                "mediaCaption": "",
+            }
+        ).to_csv(folder / f"group{group}.csv", index=False)
+
+
+async def run(base, compact, analyzer):
+    pre = Preprocessor(base, compact=compact)
+    keyword_index = pre.get_keyword_index("keywords.xlsx")
+    watermarks = WatermarkStore(base / f"watermarks_{compact}.json", keyword_index)
+    c = ChatProcessor(
+        keyword_index,
+        analyzer,
+        workers=4,
+        watermarks=watermarks,
+    )
+    path = base / f"out_{compact}.csv"
+    with open_sink(path) as sink:
+        for sheet, chat in pre.iter_chat_dfs("chats"):
+            df = await c.process_chat_df(chat, sheet)
+            sink.write(sheet, df)
+            watermarks.advance(df)
+    watermarks.save()
+    marks = json.loads(watermarks.path.read_text(encoding="utf-8"))["groups"]
+    return pd.read_csv(path, dtype=str), marks
+
+
+def test_compact_run_matches_default(tmp_path, analyzer):
+    write_data(tmp_path)
+    compact, compact_marks = asyncio.run(run(tmp_path, True, analyzer))
+    default, default_marks = asyncio.run(run(tmp_path, False, analyzer))
+
+    pd.testing.assert_frame_equal(compact, default)
+    assert compact_marks == default_marks
+    assert compact_marks["group0"]["timestamp"] == "2024-01-03T10:03:00"
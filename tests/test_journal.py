@@ -0,0 +1,77 @@
+import asyncio
+import json
+
+import pandas as pd
+
+from utils.chatprocessor import ChatProcessor
+from utils.journal import ResultJournal
+from utils.preprocessor import Preprocessor
+
+
+def write_data(base):
+    pd.DataFrame(
+        {
+            "brand": ["a2", "friso"],
+            "product": ["generic", "generic"],
+            "keyword": ["a2", "美素"],
+            "required_product": ["", ""],
+        }
+    ).to_excel(base / "keywords.xlsx", index=False)
+
+    for nature in ("mum", "dad"):
+        folder = base / "chats" / nature
+        folder.mkdir(parents=True)
+        pd.DataFrame(
+            {
+                "Date1": "",
+                "Date2": "01/01/2024",
+                "Time": [f"10:0{i}:00" for i in range(3)],
+                "userPhone": "852",
+                "quotedMessage": "",
+                "messageBody": [f"{nature} a2", f"{nature} 美素", "hello"],
+                "mediaType": "",
+                "mediaCaption": "",
+            }
+        ).to_csv(folder / f"{nature}_group.csv", index=False)
+
+
+async def run(base, analyzer, resume=False):
+    pre = Preprocessor(base)
+    journal = ResultJournal(base / "journal.jsonl", resume=resume)
+    c = ChatProcessor(
+        pre.get_keyword_index("keywords.xlsx"), analyzer, workers=4, journal=journal
+    )
+    # as main.process_sheets, one sheet after another
+    for sheet, chat in pre.iter_chat_dfs("chats"):
+        await c.process_chat_df(chat, sheet)
+    journal.close()
+    return journal
+
+
+def read_journal(path):
+    return [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+
+
+def test_journal_records_carry_their_sheet(tmp_path, analyzer):
+    write_data(tmp_path)
+    asyncio.run(run(tmp_path, analyzer))
+
+    records = read_journal(tmp_path / "journal.jsonl")
+    assert len(records) == 4
+    assert {(r["sheet"], r["source"]) for r in records} == {
+        ("mum", "mum_group"),
+        ("dad", "dad_group"),
+    }
+
+
+def test_run_without_resume_keeps_previous_journal(tmp_path, analyzer):
+    write_data(tmp_path)
+    asyncio.run(run(tmp_path, analyzer))
+    first = read_journal(tmp_path / "journal.jsonl")
+
+    journal = asyncio.run(run(tmp_path, analyzer))
+    assert journal.rotated == tmp_path / "journal.prev.jsonl"
+    assert read_journal(journal.rotated) == first
+
+    resumed = asyncio.run(run(tmp_path, analyzer, resume=True))
+    assert resumed.resumed == 4
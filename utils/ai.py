@@ -2,7 +2,8 @@ import asyncio
 import json
 import os
 import re
-from typing import Literal
+import time
+from typing import Iterable, Iterator, Literal, TypeVar
 
 from aiolimiter import AsyncLimiter
 from dotenv import load_dotenv
@@ -10,10 +11,17 @@ from openai import APIConnectionError, APIStatusError, AsyncOpenAI, OpenAI
 from openai.types.chat import ChatCompletion, ChatCompletionMessageParam
 from pydantic import ValidationError
 
-from utils.validator import SentimentResponse
+from utils.cache import ResponseCache
+from utils.limiter import AdaptiveLimiter
+from utils.retry import (CircuitBreaker, ErrorClass, LLMRequestError,
+                         ProviderError, RetryPolicy)
+from utils.validator import (BatchSentimentItem, BatchSentimentResponse,
+                             MultiSentimentResponse, SentimentResponse)
 
 load_dotenv()
 
+ResponseT = TypeVar("ResponseT", SentimentResponse, MultiSentimentResponse)
+
 
 class LLMProvider:
 
@@ -25,14 +33,26 @@ class LLMProvider:
         max_concurrent_task: int,
         max_rate: int,
         time_preiod: int,
+        adaptive: bool = True,
     ):
         self.name = name
         self.base_url = base_url
         self.model = model
         self.client = OpenAI(api_key=self.api_key, base_url=self.base_url)
-        self.client_async = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url)
-        self.sem = asyncio.Semaphore(max_concurrent_task)
+        # 429s must reach the adaptive limiter instead of being retried inside the client
+        self.client_async = AsyncOpenAI(
+            api_key=self.api_key, base_url=self.base_url, max_retries=0
+        )
+        # hard ceiling of the configured rate, the adaptive limiter stays below it
         self.limiter = AsyncLimiter(max_rate=max_rate, time_period=time_preiod)
+        self.controller = AdaptiveLimiter(
+            max_concurrent_task, max_rate, time_preiod, adaptive=adaptive
+        )
+        self.breaker = CircuitBreaker()
+
+    @property
+    def limits(self) -> str:
+        return self.controller.limits
 
     @property
     def api_key(self) -> str:
@@ -56,24 +76,49 @@ class LLMProvider:
 
     async def get_completion_async(
         self, messages: list[ChatCompletionMessageParam]
-    ) -> tuple[Literal[True], ChatCompletion] | tuple[Literal[False], str]:
-        async with self.limiter:
-            async with self.sem:
+    ) -> tuple[Literal[True], ChatCompletion] | tuple[Literal[False], ProviderError]:
+        # hold new requests while the provider is considered unhealthy
+        probe = await self.breaker.wait()
+        try:
+            # the controller slot is released however the request ends
+            async with self.limiter, self.controller:
+                start = time.monotonic()
                 try:
-                    response = await self.client_async.chat.completions.create(
+                    raw = await self.client_async.chat.completions.with_raw_response.create(
                         model=self.model, messages=messages, stream=False
                     )
-                    return True, response
-                except APIStatusError as e:
-                    return False, f"APIStatusError: {e}"
-                except APIConnectionError as e:
-                    return False, f"APIConnectionError: {e}"
+                    self.controller.on_success(time.monotonic() - start, raw.headers)
+                    self.breaker.record_success(probe)
+                    return True, raw.parse()
+                except (APIStatusError, APIConnectionError) as e:
+                    if isinstance(e, APIStatusError) and e.status_code in (429, 503, 529):
+                        self.controller.on_throttle(e.response.headers)
+                    error = ProviderError.from_exception(e)
+                    self.breaker.record_failure(error.error_class, probe)
+                    return False, error
+        finally:
+            self.breaker.end_probe(probe)
 
 
 class SentimentAnalyzer:
 
-    def __init__(self, provider: LLMProvider):
+    def __init__(
+        self,
+        provider: LLMProvider,
+        cache: ResponseCache | None = None,
+        batch_size: int = 1,
+        batch_max_tokens: int = 8000,
+        multi_target: bool = False,
+        retry_policy: RetryPolicy | None = None,
+    ):
         self.provider = provider
+        self.cache = cache
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.batch_size = batch_size
+        self.batch_max_tokens = batch_max_tokens
+        self.multi_target = multi_target
+        self.batch_system_prompt = self._get_batch_system_prompt("[]")
+        self.multi_system_prompt = self._get_multi_system_prompt("[]")
         self.system_prompt = """
 ### 角色設定
 你是一位專精於嬰兒配方奶粉及母嬰健康的市場研究分析師。你的任務是分析媽媽群組（WhatsApp）對話中的情緒。
@@ -130,6 +175,79 @@ class SentimentAnalyzer:
 }}
         """
         self.system_prompt = updated_prompt
+        self.batch_system_prompt = self._get_batch_system_prompt(keywords)
+        self.multi_system_prompt = self._get_multi_system_prompt(keywords)
+
+    def _get_batch_system_prompt(self, keywords: str) -> str:
+        return f"""
+### 角色設定
+你是一位專精於嬰兒配方奶粉及母嬰健康的市場研究分析師。你的任務是分析媽媽群組（WhatsApp）對話中的情緒。
+
+### 任務
+用戶會提供一個 JSON 陣列，每個元素包含 `id` 及 `text`（格式為「Formula Brand: 品牌, Message: 訊息」）。請逐一針對每個元素中的「特定奶粉品牌」進行情緒分析。在分析時，請特別注意參考提供的【關鍵字定義】。
+
+### 品牌關鍵字定義 (JSON)
+以下是用於輔助判斷評論相關品牌的關鍵字列表：
+{keywords}
+
+### 規則
+1. **僅限目標品牌：** 每個元素只專注於針對該元素指定品牌的情緒，元素之間互不影響。
+2. **關鍵字匹配：** 請檢查文本是否包含【品牌關鍵字定義】中的詞彙。
+   - 評論如果出現關鍵字，可傾向於判斷評論為關鍵字相關品牌。
+3. **情緒判斷邏輯：**
+   - **P (正面)：** 讚賞、推薦、有意購買、提及正面健康效果（如：長肉、大便靚），或命中正面關鍵字。
+   - **N (負面)：** 投訴、副作用（如：便秘、熱氣、敏感）、價格過高、拒絕購買，或命中負面關鍵字。
+   - **I (中立)：** 一般查詢（如：哪裡買？）、事實陳述、情緒好壞參半、提及品牌但無主觀評價。
+4. **輸出格式：** 僅回傳一個原始 JSON 陣列，每個輸入元素對應一個輸出元素，並保留原本的 `id`。嚴格遵守下方輸出 JSON 結構，不可有任何格式以外文字。
+5. **語言：** JSON 中的 `reason` 欄位必須使用繁體中文。
+
+### 輸出 JSON 結構
+[
+    {{
+        "id": 0,
+        "sentiment": "P", 或 "N", 或 "I"
+        "reason": "在此輸入50字以內的繁體中文解釋，說明判斷原因（若有命中關鍵字請提及）"
+    }}
+]
+"""
+
+    def _get_multi_system_prompt(self, keywords: str) -> str:
+        return f"""
+### 角色設定
+你是一位專精於嬰兒配方奶粉及母嬰健康的市場研究分析師。你的任務是分析媽媽群組（WhatsApp）對話中的情緒。
+
+### 任務
+用戶會提供一段文本（格式為「Formula Brands: 品牌1, 品牌2, Message: 訊息」），文本中提及多個奶粉品牌。請針對列出的每一個品牌分別進行情緒分析。在分析時，請特別注意參考提供的【關鍵字定義】。
+
+### 品牌關鍵字定義 (JSON)
+以下是用於輔助判斷評論相關品牌的關鍵字列表：
+{keywords}
+
+### 規則
+1. **逐一品牌判斷：** 每個品牌只專注於針對該品牌的情緒，比較性評論中對其他品牌的評價不應影響該品牌的判斷。
+2. **關鍵字匹配：** 請檢查文本是否包含【品牌關鍵字定義】中的詞彙。
+   - 評論如果出現關鍵字，可傾向於判斷評論為關鍵字相關品牌。
+3. **情緒判斷邏輯：**
+   - **P (正面)：** 讚賞、推薦、有意購買、提及正面健康效果（如：長肉、大便靚），或命中正面關鍵字。
+   - **N (負面)：** 投訴、副作用（如：便秘、熱氣、敏感）、價格過高、拒絕購買，或命中負面關鍵字。
+   - **I (中立)：** 一般查詢（如：哪裡買？）、事實陳述、情緒好壞參半、提及品牌但無主觀評價。
+4. **輸出格式：** 僅回傳一個原始 JSON 物件，`results` 中的鍵必須與列出的品牌名稱完全相同，且每個品牌都要有結果。嚴格遵守下方輸出 JSON 結構，不可有任何格式以外文字。
+5. **語言：** JSON 中的 `reason` 欄位必須使用繁體中文。
+
+### 輸出 JSON 結構
+{{
+    "results": {{
+        "品牌1": {{
+            "sentiment": "P", 或 "N", 或 "I"
+            "reason": "在此輸入50字以內的繁體中文解釋，說明判斷原因（若有命中關鍵字請提及）"
+        }}
+    }}
+}}
+"""
+
+    @staticmethod
+    def user_prompt(header: str, message: str) -> str:
+        return f"Formula Brand: {header}, Message: {message}"
 
     async def analyze(self, user_prompt: str) -> SentimentResponse:
         messages: list[ChatCompletionMessageParam] = [
@@ -137,49 +255,216 @@ class SentimentAnalyzer:
             {"role": "user", "content": user_prompt},
         ]
 
-        return await self.get_valid_response(messages, SentimentResponse)
+        if self.cache is None:
+            return await self.get_valid_response(messages, SentimentResponse)
+
+        key = self.cache.make_key(self.provider.model, self.system_prompt, user_prompt)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return SentimentResponse.model_validate_json(cached)
+
+        response = await self.get_valid_response(messages, SentimentResponse)
+        self.cache.set(key, self.provider.model, response.model_dump_json())
+        return response
+
+    async def analyze_multi(
+        self, headers: list[str], message: str
+    ) -> dict[str, SentimentResponse]:
+        """
+        Analyzes one message for several brands in a single request. Brands
+        missing from the answer fall back to a single-brand request.
+        """
+        user_prompt = f"Formula Brands: {', '.join(headers)}, Message: {message}"
+        messages: list[ChatCompletionMessageParam] = [
+            {"role": "system", "content": self.multi_system_prompt},
+            {"role": "user", "content": user_prompt},
+        ]
+
+        response: MultiSentimentResponse | None = None
+        key = ""
+        if self.cache is not None:
+            key = self.cache.make_key(
+                self.provider.model, self.multi_system_prompt, user_prompt
+            )
+            cached = self.cache.get(key)
+            if cached is not None:
+                response = MultiSentimentResponse.model_validate_json(cached)
+
+        if response is None:
+            response = await self.get_valid_response(messages, MultiSentimentResponse)
+            if self.cache is not None:
+                self.cache.set(key, self.provider.model, response.model_dump_json())
+
+        results: dict[str, SentimentResponse] = {}
+        for header in headers:
+            brand = response.results.get(header)
+            if brand is None:
+                results[header] = await self.analyze(self.user_prompt(header, message))
+            else:
+                results[header] = SentimentResponse(
+                    success=True, sentiment=brand.sentiment, reason=brand.reason
+                )
+        return results
+
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        # CJK text is roughly one token per character, latin text less, so
+        # the character count is a safe upper bound
+        return len(text)
+
+    def pack_batches(self, user_prompts: Iterable[str]) -> Iterator[list[int]]:
+        """
+        Groups prompt positions into batches of at most batch_size prompts
+        whose estimated message and answer tokens stay under batch_max_tokens.
+        Prompts are consumed lazily and each batch is yielded once full.
+        """
+        current: list[int] = []
+        current_tokens = 0
+        for i, prompt in enumerate(user_prompts):
+            # id / sentiment / 50 character reason of the answer
+            tokens = self.estimate_tokens(prompt) + 80
+            if current and (
+                len(current) >= self.batch_size
+                or current_tokens + tokens > self.batch_max_tokens
+            ):
+                yield current
+                current, current_tokens = [], 0
+            current.append(i)
+            current_tokens += tokens
+        if current:
+            yield current
+
+    async def analyze_batch(
+        self, user_prompts: list[str], max_retries: int = 3
+    ) -> list[SentimentResponse]:
+        """
+        Analyzes several prompts in one request. Ids that are missing or
+        invalid in the answer are re-sent together as a smaller batch in the
+        next round.
+        """
+        results: dict[int, SentimentResponse] = {}
+        keys: dict[int, str] = {}
+        if self.cache is not None:
+            for i, prompt in enumerate(user_prompts):
+                keys[i] = self.cache.make_key(
+                    self.provider.model, self.batch_system_prompt, prompt
+                )
+                cached = self.cache.get(keys[i])
+                if cached is not None:
+                    results[i] = SentimentResponse.model_validate_json(cached)
+
+        pending = {i: p for i, p in enumerate(user_prompts) if i not in results}
+        attempts: dict[str, int] = {}
+        error_class: ErrorClass = "validation"
+        error = ""
+        while pending:
+            items = [{"id": i, "text": prompt} for i, prompt in pending.items()]
+            messages: list[ChatCompletionMessageParam] = [
+                {"role": "system", "content": self.batch_system_prompt},
+                {"role": "user", "content": json.dumps(items, ensure_ascii=False)},
+            ]
+            success, response = await self.provider.get_completion_async(messages)
+
+            retry_after = None
+            if isinstance(response, ProviderError):
+                error_class, error = response.error_class, str(response)
+                retry_after = response.retry_after
+            else:
+                valid: dict[int, BatchSentimentItem] = {}
+                content = response.choices[0].message.content
+                if isinstance(content, str):
+                    valid, error = self.parse_and_validate_batch(content, set(pending))
+                else:
+                    error = "LLM returned an empty message."
+
+                for i, item in valid.items():
+                    result = SentimentResponse(
+                        success=True, sentiment=item.sentiment, reason=item.reason
+                    )
+                    results[i] = result
+                    del pending[i]
+                    if self.cache is not None:
+                        self.cache.set(
+                            keys[i], self.provider.model, result.model_dump_json()
+                        )
+                error_class = "validation"
+
+            if not pending:
+                break
+            attempts[error_class] = attempts.get(error_class, 0) + 1
+            if attempts[error_class] >= self._max_attempts(error_class, max_retries):
+                break
+            await asyncio.sleep(
+                self.retry_policy.delay(error_class, attempts[error_class], retry_after)
+            )
+
+        for i in pending:
+            results[i] = SentimentResponse(
+                success=False,
+                error=error_class,
+                reason=f"Failed to get valid batch result ({error_class}). {error}",
+            )
+        return [results[i] for i in range(len(user_prompts))]
 
     async def get_valid_response(
         self,
         messages: list[ChatCompletionMessageParam],
-        model_class: type[SentimentResponse],
+        model_class: type[ResponseT],
         max_retries: int = 3,
-    ):
-
-        for _ in range(max_retries):
+    ) -> ResponseT:
+        """
+        Sends messages until a valid answer comes back. Provider errors are
+        retried with the backoff of their class, invalid JSON is fed back to
+        the LLM; LLMRequestError is raised once a class runs out of attempts.
+        """
+        attempts: dict[str, int] = {}
+        while True:
             success, response = await self.provider.get_completion_async(messages)
 
-            try:
-                if isinstance(response, ChatCompletion) and isinstance(
-                    response.choices[0].message.content, str
-                ):
-                    response_text: str = response.choices[0].message.content
+            retry_after = None
+            if isinstance(response, ProviderError):
+                error_class, error = response.error_class, str(response)
+                retry_after = response.retry_after
+            else:
+                response_text = response.choices[0].message.content
+                try:
+                    if not isinstance(response_text, str):
+                        raise ValueError("LLM returned an empty message.")
                     return self.parse_and_validate(response_text, model_class)
-            except ValueError as e:
-                # Feed the error back to the LLM!
-                error_msg = f"Your JSON was invalid. Error: {str(e)}. Please fix and output only JSON."
-                messages.append({"role": "assistant", "content": response_text})
-                messages.append({"role": "user", "content": error_msg})
-
-        raise Exception(
-            f"Failed to get valid JSON after {max_retries} times of retries"
-        )
+                except ValueError as e:
+                    error_class, error = "validation", str(e)
+                    # Feed the error back to the LLM!
+                    error_msg = f"Your JSON was invalid. Error: {str(e)}. Please fix and output only JSON."
+                    messages.append(
+                        {"role": "assistant", "content": response_text or ""}
+                    )
+                    messages.append({"role": "user", "content": error_msg})
+
+            attempts[error_class] = attempts.get(error_class, 0) + 1
+            if attempts[error_class] >= self._max_attempts(error_class, max_retries):
+                raise LLMRequestError(
+                    error_class,
+                    f"Failed after {attempts[error_class]} {error_class} errors: {error}",
+                )
+            await asyncio.sleep(
+                self.retry_policy.delay(error_class, attempts[error_class], retry_after)
+            )
+
+    def _max_attempts(self, error_class: str, max_retries: int) -> int:
+        # max_retries keeps bounding the JSON correction rounds
+        if error_class == "validation":
+            return max_retries
+        return self.retry_policy.max_attempts(error_class)
 
     def parse_and_validate(
-        self, llm_output: str, model_class: type[SentimentResponse]
-    ) -> SentimentResponse:
+        self, llm_output: str, model_class: type[ResponseT]
+    ) -> ResponseT:
         """
         Strips markdown, parses JSON, and validates against Pydantic model.
         """
         try:
             # Step A: Clean Markdown (LLMs love to wrap JSON in ```json ... ```)
-            # Look for content between ```json and ``` or just ``` and ```
-            match = re.search(r"```(?:json)?(.*?)```", llm_output, re.DOTALL)
-            if match:
-                json_str = match.group(1).strip()
-            else:
-                # Assume the whole string is JSON if no markdown found
-                json_str = llm_output.strip()
+            json_str = self._strip_markdown(llm_output)
 
             # Step B: Parse JSON
             data = json.loads(json_str)
@@ -194,6 +479,49 @@ class SentimentAnalyzer:
         except ValidationError as e:
             raise ValueError(f"JSON structure invalid: {e}")
 
+    @staticmethod
+    def _strip_markdown(llm_output: str) -> str:
+        # Look for content between ```json and ``` or just ``` and ```
+        match = re.search(r"```(?:json)?(.*?)```", llm_output, re.DOTALL)
+        if match:
+            return match.group(1).strip()
+        # Assume the whole string is JSON if no markdown found
+        return llm_output.strip()
+
+    def parse_and_validate_batch(
+        self, llm_output: str, expected_ids: set[int]
+    ) -> tuple[dict[int, BatchSentimentItem], str]:
+        """
+        Parses a JSON array answer and returns the valid items of the expected
+        ids, together with a description of what was wrong with the rest.
+        """
+        try:
+            data = json.loads(self._strip_markdown(llm_output))
+        except json.JSONDecodeError:
+            return {}, "LLM did not return valid JSON syntax."
+        if not isinstance(data, list):
+            return {}, "LLM did not return a JSON array."
+
+        for item in data:
+            if isinstance(item, dict):
+                item["success"] = True
+
+        try:
+            items = BatchSentimentResponse.model_validate(data).root
+            error = ""
+        except ValidationError as e:
+            # keep the valid items, the invalid ones get re-submitted
+            items = []
+            for item in data:
+                try:
+                    items.append(BatchSentimentItem.model_validate(item))
+                except ValidationError:
+                    pass
+            error = f"JSON structure invalid: {e}"
+
+        valid = {item.id: item for item in items if item.id in expected_ids}
+        return valid, error
+
 
 def get_analyzer(
     provider_name: str,
@@ -201,6 +529,11 @@ def get_analyzer(
     max_concurrent_task: int = 50,
     max_rate: int = 100,
     time_period: int = 60,
+    cache: ResponseCache | None = None,
+    batch_size: int = 1,
+    batch_max_tokens: int = 8000,
+    multi_target: bool = False,
+    adaptive: bool = True,
 ) -> SentimentAnalyzer:
     provider_name = provider_name.lower().strip()
     match provider_name.lower().strip():
@@ -208,6 +541,18 @@ def get_analyzer(
             base_url = "https://api.poe.com/v1"
 
     provider = LLMProvider(
-        provider_name, base_url, model_name, max_concurrent_task, max_rate, time_period
+        provider_name,
+        base_url,
+        model_name,
+        max_concurrent_task,
+        max_rate,
+        time_period,
+        adaptive=adaptive,
     )
-    return SentimentAnalyzer(provider)
\ No newline at end of file
+    return SentimentAnalyzer(
+        provider,
+        cache=cache,
+        batch_size=batch_size,
+        batch_max_tokens=batch_max_tokens,
+        multi_target=multi_target,
+    )
\ No newline at end of file
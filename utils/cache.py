@@ -0,0 +1,108 @@
+import hashlib
+import sqlite3
+import time
+from pathlib import Path
+
+
+class ResponseCache:
+    """
+    Persistent SQLite cache of validated LLM responses, keyed on model name,
+    system prompt and user prompt.
+    """
+
+    def __init__(
+        self,
+        path: str | Path,
+        max_entries: int = 1_000_000,
+        max_age_days: float | None = 90,
+    ) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                response TEXT NOT NULL,
+                created REAL NOT NULL
+            )
+            """
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_created ON responses (created)"
+        )
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(model: str, system_prompt: str, user_prompt: str) -> str:
+        system_hash = hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()
+        raw = "\x00".join([model, system_hash, user_prompt])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    @property
+    def _min_created(self) -> float:
+        if self.max_age_days is None:
+            return 0.0
+        return time.time() - self.max_age_days * 86400
+
+    def get(self, key: str) -> str | None:
+        row = self.conn.execute(
+            "SELECT response FROM responses WHERE key = ? AND created >= ?",
+            (key, self._min_created),
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0]
+
+    def set(self, key: str, model: str, response: str) -> None:
+        self.conn.execute(
+            "INSERT OR REPLACE INTO responses (key, model, response, created) VALUES (?, ?, ?, ?)",
+            (key, model, response, time.time()),
+        )
+        self.conn.commit()
+
+    def evict(self) -> int:
+        """
+        Drops entries older than max_age_days, then the oldest entries beyond
+        max_entries. Returns the number of rows removed.
+        """
+        removed = self.conn.execute(
+            "DELETE FROM responses WHERE created < ?", (self._min_created,)
+        ).rowcount
+        removed += self.conn.execute(
+            """
+            DELETE FROM responses WHERE key IN (
+                SELECT key FROM responses ORDER BY created DESC LIMIT -1 OFFSET ?
+            )
+            """,
+            (self.max_entries,),
+        ).rowcount
+        self.conn.commit()
+        return removed
+
+    def clear(self) -> None:
+        self.conn.execute("DELETE FROM responses")
+        self.conn.commit()
+        self.conn.execute("VACUUM")
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def summary(self) -> str:
+        total = self.hits + self.misses
+        rate = (self.hits / total * 100) if total else 0.0
+        return f"LLM cache: {self.hits} hits, {self.misses} misses ({rate:.1f}% hit rate), {len(self)} entries"
+
+    def close(self) -> None:
+        self.evict()
+        self.conn.close()
@@ -1,66 +1,175 @@
-import asyncio
-import json
-import re
-from typing import Any, Coroutine, cast
+from typing import (TYPE_CHECKING, AsyncIterator, Iterable, Iterator, Mapping,
+                    cast)
 
+import numpy as np
 import pandas as pd
 from pandera.typing import DataFrame
-from tqdm.asyncio import tqdm as tqdmas
+from tqdm import tqdm
 
 from utils.ai import SentimentAnalyzer
+from utils.journal import ResultJournal
+from utils.keywords import KeywordIndex
+from utils.scheduler import TaskScheduler
+from utils.sink import open_sink
+from utils.tagger import KeywordTagger
 from utils.validator import (ChatRow, ChatSchema, KeywordRow, KeywordSchema,
                              SentimentResponse)
 
+if TYPE_CHECKING:
+    # watermark imports FAILED_STATUS from here
+    from utils.watermark import WatermarkStore
+
+
+# header cell value of rows whose request failed for good
+FAILED_STATUS = "FAILED"
+
+# (sheet, row index)
+RowRef = tuple[str, int]
+# (headers, normalized message, rows sharing the prompt)
+PromptEntry = tuple[tuple[str, ...], str, list[RowRef]]
+# (header, rows, response)
+SentimentResult = tuple[str, list[RowRef], SentimentResponse]
+# (rows to analyze, previous results of the rows behind the watermark, hits)
+TaggedSheet = tuple[DataFrame[ChatSchema], pd.DataFrame, pd.DataFrame]
+
 
 class ChatProcessor:
 
     def __init__(
-        self, keyword_df: DataFrame[KeywordSchema], analyzer: SentimentAnalyzer
+        self,
+        keyword_df: DataFrame[KeywordSchema] | KeywordIndex,
+        analyzer: SentimentAnalyzer,
+        workers: int = 400,
+        journal: ResultJournal | None = None,
+        watermarks: "WatermarkStore | None" = None,
+        wide: bool = True,
     ):
-        self._keyword_df = keyword_df
+        if isinstance(keyword_df, KeywordIndex):
+            self.index = keyword_df
+        else:
+            self.index = KeywordIndex(keyword_df)
         self.analyzer = analyzer
+        self.scheduler = TaskScheduler(workers=workers)
+        self.journal = journal
+        self.watermarks = watermarks
+        # export one column per header, otherwise one row per keyword hit
+        self.wide = wide
+        # sheet -> stable keys of the rows sent, only while the sheet is open
+        self._row_keys: dict[str, pd.Series] = {}
+        # sheet -> (header, row index, status, reason) until the sheet completes
+        self._results: dict[str, list[tuple[str, int, str, str]]] = {}
+        self.collapsed_calls = 0
+        # error class -> rows whose request failed for good
+        self.failures: dict[str, int] = {}
 
     @property
-    def keyword_df(self):
-        return self._keyword_df
+    def keyword_df(self) -> DataFrame[KeywordSchema]:
+        return self.index.keyword_df
+
+    @property
+    def tagger(self) -> KeywordTagger:
+        return self.index.tagger
 
     @property
     def unique_headers(self) -> list[str]:
-        return list(self._keyword_df["headers"].unique())
+        return self.index.unique_headers
 
     @property
     def generic_headers(self) -> list[str]:
-        return [header for header in self.unique_headers if "generic" in header]
+        return self.index.generic_headers
 
     @property
     def non_generic_headers(self) -> list[str]:
-        return [header for header in self.unique_headers if "generic" not in header]
+        return self.index.non_generic_headers
 
     async def process_chat_df(
-        self, chat_df: DataFrame[ChatSchema]
+        self, chat_df: DataFrame[ChatSchema], sheet: str = ""
     ) -> DataFrame[ChatSchema]:
-        df = chat_df.copy()
-        df = self._add_header_columns_to_chat_df(chat_df)
-        df = self._tag_keywords(df)
-        self._add_keywords_for_system_prompt()
-        df = await self._check_sentiment(df)
+        # sheet names the frame in the journal and the progress messages
+        sheets = dict(
+            [item async for item in self.process_chat_dfs({sheet: chat_df})]
+        )
+        return sheets[sheet]
 
-        return df
+    async def process_chat_dfs(
+        self,
+        chats: Mapping[str, DataFrame[ChatSchema]]
+        | Iterable[tuple[str, DataFrame[ChatSchema]]],
+    ) -> AsyncIterator[tuple[str, DataFrame[ChatSchema]]]:
+        """
+        Tags every sheet, then feeds the LLM requests of all sheets into one
+        scheduler. Sheets are yielded as soon as their last result is written.
+        chats is a dict or an iterable of (sheet, frame) pairs, such as
+        Preprocessor.iter_chat_dfs; the prompts of all sheets are collapsed
+        together, so it is consumed before the first request is sent.
+        """
+        items = chats.items() if isinstance(chats, Mapping) else chats
+        tagged = {sheet: self.tag_chat_df(sheet, chat_df) for sheet, chat_df in items}
+        async for item in self.process_tagged(tagged):
+            yield item
+
+    def tag_chat_df(self, sheet: str, chat_df: DataFrame[ChatSchema]) -> TaggedSheet:
+        """
+        Splits off the rows behind the watermark, whose previous results are
+        reused, and builds the keyword hit table of the rest.
+        """
+        reused = chat_df.iloc[0:0]
+        if self.watermarks is not None:
+            chat_df, reused = self.watermarks.split(chat_df)
+            if len(reused):
+                label = f"{sheet}: " if sheet else ""
+                tqdm.write(
+                    f"{label}{len(chat_df)} new rows past the watermark, "
+                    f"{len(reused)} reused from the previous output"
+                )
+        return chat_df, reused, self._tag_keywords(chat_df)
+
+    async def process_tagged(
+        self, tagged: Mapping[str, TaggedSheet]
+    ) -> AsyncIterator[tuple[str, DataFrame[ChatSchema]]]:
+        """
+        Sends the LLM requests of sheets returned by tag_chat_df and yields
+        each sheet as soon as its last result is written.
+        """
+        self._add_keywords_for_system_prompt()
+        frames = {sheet: frame for sheet, (frame, _, _) in tagged.items()}
+        hits = {sheet: sheet_hits for sheet, (_, _, sheet_hits) in tagged.items()}
+        async for sheet in self._check_sentiment(frames, hits):
+            reused = tagged[sheet][1]
+            if len(reused):
+                yield sheet, self._merge_previous(frames[sheet], reused)
+            else:
+                yield sheet, frames[sheet]
+
+    @staticmethod
+    def _merge_previous(
+        chat_df: DataFrame[ChatSchema], previous: pd.DataFrame
+    ) -> DataFrame[ChatSchema]:
+        # both parts carry the row positions of the input sheet
+        merged = pd.concat([chat_df, previous.reindex(columns=chat_df.columns)])
+        return cast(DataFrame[ChatSchema], merged.sort_index())
 
     def _get_keyword_rows_of_header(self, header: str) -> DataFrame[KeywordSchema]:
-        return self._keyword_df[self._keyword_df["headers"] == header]
-
-    def _tag_keywords(self, chat_df: DataFrame[ChatSchema]) -> DataFrame[ChatSchema]:
-        for ng in self.non_generic_headers:
-            self._apply_mask(chat_df, ng, skip_mask=None)
-
-        for g in self.generic_headers:
-            main = g.replace("_generic", "")
-            subbrand = [brand for brand in self.non_generic_headers if main in brand]
-            skip_mask = chat_df[subbrand].any(axis=1)
-
-            self._apply_mask(chat_df, g, skip_mask=skip_mask)
-        return chat_df
+        return self.index.rows_of_header(header)
+
+    def _tag_keywords(self, chat_df: DataFrame[ChatSchema]) -> pd.DataFrame:
+        """
+        Sparse hit table of a sheet: one (row index, header) pair per matched
+        header, grouped by header in header order.
+        """
+        positions = self.tagger.tag(chat_df["messageBody"].tolist())
+        headers = [h for h in self.unique_headers if len(positions.get(h, ()))]
+        rows = [np.asarray(positions[h], dtype=np.int64) for h in headers]
+        found = np.concatenate(rows) if rows else np.array([], dtype=np.int64)
+        return pd.DataFrame(
+            {
+                "index": chat_df.index.to_numpy()[found],
+                "header": pd.Categorical(
+                    np.repeat(headers, [len(r) for r in rows]),
+                    categories=self.unique_headers,
+                ),
+            }
+        )
 
     # def _apply_mask_old(
     #     self,
@@ -95,122 +204,220 @@ class ChatProcessor:
 
     #     return chat_df
 
-    def _apply_mask(
-        self,
-        chat_df: pd.DataFrame,  # simplified type hint for clarity
-        header: str,
-        skip_mask: pd.Series | None,
-        message_column: str = "messageBody",
-    ) -> pd.DataFrame:
-        matched = self._get_keyword_rows_of_header(header)
-
-        # If no keywords match this header, return early to save processing
-        if matched.empty:
-            return chat_df
-
-        # 1. Define the target series based on the skip_mask
-        if skip_mask is None:
-            target_indices = chat_df.index
-            target_series = chat_df[message_column]
-        else:
-            target_indices = chat_df.index[~skip_mask]
-            target_series = chat_df.loc[~skip_mask, message_column]
-
-        # 2. Construct a single compiled Regex pattern
-        # The original logic seemed to imply OR logic between rows (though the loop overwrote it).
-        # We assume you want to flag the row if ANY of the keyword rules match.
-
-        # Group 1: Keywords that have NO required_keyword
-        simple_keywords = matched[
-            matched["required_keyword"].isna() | (matched["required_keyword"] == "")
-        ]["keyword"].tolist()
-
-        # Group 2: Keywords that DO have a required_keyword
-        complex_rows = matched[
-            matched["required_keyword"].notna() & (matched["required_keyword"] != "")
-        ]
+    def _apply_results(
+        self, chat_df: DataFrame[ChatSchema], results: list[tuple[str, int, str, str]]
+    ) -> DataFrame[ChatSchema]:
+        """
+        Turns the long-form results of a completed sheet into its export
+        layout: one column per header (wide) or one row per hit (long).
+        """
+        found = pd.DataFrame(results, columns=["header", "index", "status", "reason"])
+        # reasons of a row follow the header order, whatever the arrival order
+        order = {header: i for i, header in enumerate(self.unique_headers)}
+        found = found.sort_values(
+            "header", key=lambda col: col.map(order), kind="stable", ignore_index=True
+        )
+        positions = chat_df.index.get_indexer(found["index"])
+        if self.wide:
+            return self._to_wide(chat_df, found, positions)
+        return self._to_long(chat_df, found, positions)
 
-        # Initialize a mask of False for all target rows
-        combined_mask = pd.Series(False, index=target_indices)
-
-        # 3. Vectorized application for Simple Keywords (OR logic)
-        if simple_keywords:
-            # Escape keywords to treat them as literal strings in regex, join with OR pipe
-            pattern = "|".join(map(re.escape, simple_keywords))
-            combined_mask |= target_series.str.contains(pattern, case=False, na=False)
-
-        # 4. Vectorized application for Complex Keywords (AND logic per row)
-        # We cannot easily join these into one regex because of the AND relationship (keyword + required).
-        # However, we can iterate ONLY the complex rules (usually fewer) or construct a specific lookahead regex.
-        # Approach: Iterate complex rows (still faster than row-by-row if few complex rules exist)
-        if not complex_rows.empty:
-            for row in cast(list, complex_rows.itertuples(index=False)):
-                # Check (Contains Keyword) AND (Contains Required)
-                row_mask = target_series.str.contains(
-                    re.escape(row.keyword), case=False, na=False
-                ) & target_series.str.contains(
-                    re.escape(row.required_keyword), case=False, na=False
+    def _to_wide(
+        self, chat_df: DataFrame[ChatSchema], found: pd.DataFrame, positions: np.ndarray
+    ) -> DataFrame[ChatSchema]:
+        """
+        Adds one column per header holding the status of its hits, built with
+        one assignment per header, and appends the joined reasons per row.
+        The columns are categoricals, one byte per cell instead of an object.
+        """
+        statuses = pd.Index(["", *found["status"]]).unique()
+        codes = {
+            header: np.zeros(len(chat_df), dtype=np.int8)
+            for header in self.unique_headers
+        }
+        for header, rows in found.groupby("header", sort=False):
+            codes[str(header)][positions[rows.index]] = statuses.get_indexer(
+                rows["status"]
+            )
+        columns = {
+            header: pd.Categorical.from_codes(header_codes, categories=statuses)
+            for header, header_codes in codes.items()
+        }
+
+        if len(found):
+            lines = found["header"] + ": " + found["reason"] + "\n"
+            joined = lines.groupby(positions, sort=False).agg("".join)
+            reasons = chat_df["Reason"].astype(str).to_numpy(dtype=object, copy=True)
+            reasons[joined.index] = reasons[joined.index] + joined.to_numpy()
+            chat_df["Reason"] = reasons
+
+        wide = pd.DataFrame(columns, index=chat_df.index)
+        return cast(DataFrame[ChatSchema], pd.concat([chat_df, wide], axis=1))
+
+    @staticmethod
+    def _to_long(
+        chat_df: DataFrame[ChatSchema], found: pd.DataFrame, positions: np.ndarray
+    ) -> DataFrame[ChatSchema]:
+        """
+        One row per keyword hit: the message columns plus Header, Sentiment
+        and its Reason, in the row order of the sheet. Messages without any
+        hit have no row here.
+        """
+        found = found.assign(position=positions).sort_values("position", kind="stable")
+        long_df = chat_df.iloc[found["position"].to_numpy()].copy()
+        long_df["Header"] = found["header"].to_numpy()
+        long_df["Sentiment"] = found["status"].to_numpy()
+        long_df["Reason"] = found["reason"].to_numpy()
+        return cast(DataFrame[ChatSchema], long_df)
+
+    @staticmethod
+    def _normalize_message(message: str) -> str:
+        # collapse whitespace so copy-pasted / forwarded messages compare equal
+        return " ".join(str(message).split())
+
+    async def _check_sentiment(
+        self, frames: dict[str, DataFrame[ChatSchema]], hits: dict[str, pd.DataFrame]
+    ) -> AsyncIterator[str]:
+        # in multi-target mode one request covers every header flagged on a row
+        multi_target = self.analyzer.multi_target and self.analyzer.batch_size <= 1
+
+        # (headers, normalized message) -> rows sharing that prompt
+        prompt_groups: dict[tuple[tuple[str, ...], str], list[RowRef]] = {}
+        # sheet -> results still missing before it is complete
+        remaining: dict[str, int] = {}
+        resumed: list[SentimentResult] = []
+        for sheet, chat_df in frames.items():
+            self._results[sheet] = []
+            row_headers: dict[int, list[str]] = {}
+            sheet_hits = hits[sheet]
+            for index, header in zip(
+                sheet_hits["index"].tolist(), sheet_hits["header"].tolist()
+            ):
+                row_headers.setdefault(index, []).append(header)
+
+            if self.journal is not None:
+                # only rows with keyword hits are journaled
+                self._row_keys[sheet] = self.journal.row_keys(
+                    chat_df.loc[list(row_headers)]
                 )
-                combined_mask |= row_mask
-
-        # 5. Apply the result back to the DataFrame
-        # Ensure the column exists and is integer type if not already
-        if header not in chat_df.columns:
-            chat_df[header] = 0
-
-        # We use bitwise OR to merge with existing flags in that column
-        chat_df.loc[target_indices, header] = chat_df.loc[
-            target_indices, header
-        ] | combined_mask.astype(int)
+                # rows answered by an interrupted run are not sent again
+                for index, headers in list(row_headers.items()):
+                    row_key = self._row_keys[sheet].at[index]
+                    for header in list(headers):
+                        response = self.journal.get(row_key, header)
+                        if response is not None:
+                            resumed.append((header, [(sheet, index)], response))
+                            headers.remove(header)
+                    if not headers:
+                        del row_headers[index]
+
+            for index, headers in row_headers.items():
+                msg = self._normalize_message(chat_df.at[index, "messageBody"])
+                targets = [tuple(headers)] if multi_target else [(h,) for h in headers]
+                for target in targets:
+                    prompt_groups.setdefault((target, msg), []).append((sheet, index))
+            remaining[sheet] = sum(len(headers) for headers in row_headers.values())
+
+        total_pairs = sum(remaining.values())
+        collapsed = total_pairs - len(prompt_groups)
+        self.collapsed_calls += collapsed
+        if collapsed:
+            tqdm.write(
+                f"Collapsed {total_pairs} header/message pairs into {len(prompt_groups)} unique prompts"
+            )
 
-        return chat_df
+        if resumed:
+            self._collect_results(resumed)
+            tqdm.write(f"Resumed {len(resumed)} results from the journal")
 
-    def _add_header_columns_to_chat_df(
-        self, chat_df: DataFrame[ChatSchema]
-    ) -> DataFrame[ChatSchema]:
-        for header in self.unique_headers:
-            chat_df[header] = 0
-        return chat_df
+        for sheet, count in remaining.items():
+            if count == 0:
+                frames[sheet] = self._apply_results(
+                    frames[sheet], self._results.pop(sheet)
+                )
+                self._row_keys.pop(sheet, None)
+                yield sheet
 
-    def _chat_df_zero_to_string(
-        self, chat_df: DataFrame[ChatSchema], header: str
-    ) -> DataFrame[ChatSchema]:
-        # turn 0 into empty str
-        chat_df[header] = chat_df[header].astype("object")
-        chat_df.loc[chat_df[header] == 0, header] = ""
-        return chat_df
-
-    async def _check_sentiment(self, chat_df: DataFrame[ChatSchema]):
-        all_tasks: list[Coroutine[Any, Any, tuple[str, int, SentimentResponse]]] = []
-        for header in self.unique_headers:
-            df = self._chat_df_zero_to_string(chat_df, header)
-            mask = df[header] == 1
-
-            if mask.any():
-                indices = df.index[mask].tolist()
-                prompts = [
-                    f"Formula Brand: {header}, Message: {msg}"
-                    for msg in df.loc[mask, "messageBody"].tolist()
-                ]
-                tasks: list[Coroutine[Any, Any, tuple[str, int, SentimentResponse]]] = [
-                    self._wrap_analyze_with_index(prompt, int(index), header)
-                    for prompt, index in zip(prompts, indices)
-                ]
-                all_tasks.extend(tasks)
-
-        results: list[tuple[str, int, SentimentResponse]] = await tqdmas.gather(
-            *all_tasks, desc="Checking sentiment", colour="green"
+        entries: Iterator[PromptEntry] = (
+            (headers, msg, refs) for (headers, msg), refs in prompt_groups.items()
         )
-
+        progress = tqdm(
+            total=sum(len(headers) for headers, _ in prompt_groups),
+            desc="Checking sentiment",
+            colour="green",
+        )
+        async for batch_result in self._dispatch(entries):
+            progress.set_postfix_str(self.analyzer.provider.limits, refresh=False)
+            progress.update(len(batch_result))
+            if self.journal is not None:
+                self._journal_results(frames, batch_result)
+            for sheet, count in self._collect_results(batch_result).items():
+                remaining[sheet] -= count
+                if remaining[sheet] == 0:
+                    frames[sheet] = self._apply_results(
+                        frames[sheet], self._results.pop(sheet)
+                    )
+                    self._row_keys.pop(sheet, None)
+                    yield sheet
+        progress.close()
+
+    def _dispatch(
+        self, entries: Iterator[PromptEntry]
+    ) -> AsyncIterator[list[SentimentResult]]:
+        if self.analyzer.batch_size <= 1:
+            return self.scheduler.map(self._wrap_analyze_with_index, entries)
+
+        # pack_batches pulls prompts lazily, hold the entries not yet batched
+        pending: dict[int, PromptEntry] = {}
+
+        def prompts() -> Iterator[str]:
+            for i, entry in enumerate(entries):
+                pending[i] = entry
+                yield self.analyzer.user_prompt(entry[0][0], entry[1])
+
+        def batches() -> Iterator[list[PromptEntry]]:
+            for batch in self.analyzer.pack_batches(prompts()):
+                yield [pending.pop(i) for i in batch]
+
+        return self.scheduler.map(self._wrap_analyze_batch, batches())
+
+    def _journal_results(
+        self,
+        frames: dict[str, DataFrame[ChatSchema]],
+        results: list[SentimentResult],
+    ) -> None:
+        assert self.journal is not None
+        for header, refs, response in results:
+            for sheet, index in refs:
+                self.journal.record(
+                    sheet,
+                    str(frames[sheet].at[index, "Source"]),
+                    self._row_keys[sheet].at[index],
+                    header,
+                    response,
+                )
+        self.journal.flush()
+
+    def _collect_results(self, results: list[SentimentResult]) -> dict[str, int]:
+        """
+        Buffers results until their sheet is complete and returns the count
+        collected per sheet.
+        """
+        written: dict[str, int] = {}
         for result in results:
-            header, index, response = result
-            # index_str = str(index)
+            header, refs, response = result
             if response.success:
-                df.loc[index, header] = response.sentiment
+                status, reason = response.sentiment, response.reason
+            else:
+                self.failures[response.error or "unknown"] = (
+                    self.failures.get(response.error or "unknown", 0) + len(refs)
+                )
+                status, reason = FAILED_STATUS, f"[{response.error}] {response.reason}"
 
-            current_reason = str(df.loc[index, "Reason"])
-            df.loc[index, "Reason"] = current_reason + f"{header}: {response.reason}\n"
-        return df
+            for sheet, index in refs:
+                self._results[sheet].append((header, index, str(status), reason))
+                written[sheet] = written.get(sheet, 0) + 1
+        return written
 
     # async def _run_async_check(
     #     self, tasks: list[Coroutine[Any, Any, tuple[str, int, SentimentResponse]]]
@@ -223,18 +430,38 @@ class ChatProcessor:
     #     return results
 
     async def _wrap_analyze_with_index(
-        self, user_prompt: str, index: int, header: str
-    ) -> tuple[str, int, SentimentResponse]:
-        await asyncio.sleep(1)
+        self, entry: PromptEntry
+    ) -> list[SentimentResult]:
+        headers, message, refs = list(entry[0]), entry[1], entry[2]
         try:
-            response = await self.analyzer.analyze(user_prompt)
-            return header, index, response
+            if len(headers) > 1:
+                responses = await self.analyzer.analyze_multi(headers, message)
+            else:
+                user_prompt = self.analyzer.user_prompt(headers[0], message)
+                responses = {headers[0]: await self.analyzer.analyze(user_prompt)}
         except Exception as e:
-            return (
-                header,
-                index,
-                SentimentResponse(success=False, sentiment="I", reason=str(e)),
+            failed = self._failed_response(e)
+            responses = {header: failed for header in headers}
+        return [(header, refs, responses[header]) for header in headers]
+
+    async def _wrap_analyze_batch(
+        self, entries: list[PromptEntry]
+    ) -> list[SentimentResult]:
+        try:
+            responses = await self.analyzer.analyze_batch(
+                [self.analyzer.user_prompt(h[0], msg) for h, msg, _ in entries]
             )
+        except Exception as e:
+            responses = [self._failed_response(e)] * len(entries)
+        return [
+            (headers[0], refs, response)
+            for (headers, _, refs), response in zip(entries, responses)
+        ]
+
+    @staticmethod
+    def _failed_response(e: Exception) -> SentimentResponse:
+        error_class = getattr(e, "error_class", "unknown")
+        return SentimentResponse(success=False, error=error_class, reason=str(e))
 
     def _get_keywords_for_prompt(self, header: str) -> str:
         keywords: list[str] = []
@@ -248,14 +475,13 @@ class ChatProcessor:
         return ", ".join(set(keywords))
 
     def _add_keywords_for_system_prompt(self) -> None:
-        keyword_dict = self.keyword_df.to_dict(orient="records")
-        self.analyzer.system_prompt_insert_keywords(json.dumps(keyword_dict))
+        self.analyzer.system_prompt_insert_keywords(self.index.prompt_keywords)
 
     def save_result(
         self, dataframes: dict[str, DataFrame[ChatSchema]], output_path: str
     ):
-        with pd.ExcelWriter(output_path) as writer:
+        with open_sink(output_path) as sink:
             for sheetname, dataframe in dataframes.items():
-                dataframe.to_excel(writer, sheet_name=sheetname, index=False)
+                sink.write(sheetname, dataframe)
                 print(f"Sheet: {sheetname} has been added to file.")
         print("Output of file has been done.")
\ No newline at end of file
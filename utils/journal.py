@@ -0,0 +1,93 @@
+import json
+from pathlib import Path
+
+import pandas as pd
+
+from utils.validator import SentimentResponse
+
+
+class ResultJournal:
+    """
+    Append-only JSONL record of every completed LLM result, so an interrupted
+    run can be resumed without re-sending the rows already answered.
+    """
+
+    KEY_COLUMNS = ["Source", "Date2", "Time", "userPhone", "messageBody"]
+
+    def __init__(self, path: str | Path, resume: bool = False) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # (row key, header) -> successful response of a previous run. The
+        # sheet is left out as its name depends on --chunk_rows / --pipeline
+        self.answered: dict[tuple[str, str], SentimentResponse] = {}
+        self.resumed = 0
+        # where the journal of the previous run was moved, if it was
+        self.rotated: Path | None = None
+
+        if resume and self.path.exists():
+            self._load()
+        elif self.path.exists() and self.path.stat().st_size:
+            # a run without --resume must not wipe the journal of a crashed one
+            self.rotated = self.path.with_suffix(".prev" + self.path.suffix)
+            self.path.replace(self.rotated)
+        self._file = open(self.path, "a" if resume else "w", encoding="utf-8")
+
+    def _load(self) -> None:
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # last line of a killed run may be cut off
+                    continue
+                if not record.get("success"):
+                    continue
+                key = (record["row_key"], record["header"])
+                self.answered[key] = SentimentResponse(
+                    success=True, sentiment=record["sentiment"], reason=record["reason"]
+                )
+
+    @classmethod
+    def row_keys(cls, chat_df: pd.DataFrame) -> pd.Series:
+        """
+        Stable key of every row, independent of its position in the frame:
+        the 64-bit pandas hash of the key columns, as text.
+        """
+        columns = (
+            chat_df.reindex(columns=cls.KEY_COLUMNS)
+            .astype(object)
+            .fillna("")
+            .astype(str)
+        )
+        return pd.util.hash_pandas_object(columns, index=False).astype(str)
+
+    def get(self, row_key: str, header: str) -> SentimentResponse | None:
+        response = self.answered.get((row_key, header))
+        if response is not None:
+            self.resumed += 1
+        return response
+
+    def record(
+        self,
+        sheet: str,
+        source: str,
+        row_key: str,
+        header: str,
+        response: SentimentResponse,
+    ) -> None:
+        line = {
+            "sheet": sheet,
+            "source": source,
+            "row_key": row_key,
+            "header": header,
+            "success": response.success,
+            "sentiment": response.sentiment,
+            "reason": response.reason,
+        }
+        self._file.write(json.dumps(line, ensure_ascii=False) + "\n")
+
+    def flush(self) -> None:
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
@@ -0,0 +1,61 @@
+import hashlib
+import json
+import pickle
+from pathlib import Path
+
+from pandera.typing import DataFrame
+
+from utils.tagger import KeywordTagger
+from utils.validator import KeywordSchema
+
+
+class KeywordIndex:
+    """
+    Everything ChatProcessor derives from the validated keyword frame, computed
+    once: header lists, generic -> sub-brand mapping, the compiled tagger and
+    the keyword snippet of the system prompt.
+    """
+
+    # bump when the pickled layout changes so stale files are ignored
+    VERSION = 1
+
+    def __init__(self, keyword_df: DataFrame[KeywordSchema]) -> None:
+        self.keyword_df = keyword_df
+        self.tagger = KeywordTagger(keyword_df)
+        self.unique_headers: list[str] = list(keyword_df["headers"].unique())
+        self.generic_headers = self.tagger.generic_headers
+        self.non_generic_headers = self.tagger.non_generic_headers
+        self.subbrands = self.tagger.subbrands
+        self.header_rows: dict[str, DataFrame[KeywordSchema]] = {
+            str(header): rows for header, rows in keyword_df.groupby("headers")
+        }
+        self.prompt_keywords = json.dumps(keyword_df.to_dict(orient="records"))
+
+    def rows_of_header(self, header: str) -> DataFrame[KeywordSchema]:
+        return self.header_rows.get(header, self.keyword_df.iloc[0:0])
+
+    @staticmethod
+    def file_hash(path: str | Path) -> str:
+        return hashlib.sha256(Path(path).read_bytes()).hexdigest()
+
+    @classmethod
+    def cache_path(cls, keyword_path: str | Path, cache_dir: str | Path) -> Path:
+        digest = cls.file_hash(keyword_path)[:16]
+        return Path(cache_dir) / f"keyword_index_v{cls.VERSION}_{digest}.pkl"
+
+    @classmethod
+    def load(cls, path: str | Path) -> "KeywordIndex | None":
+        try:
+            with open(path, "rb") as f:
+                index = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            return None
+        return index if isinstance(index, cls) else None
+
+    def save(self, path: str | Path) -> None:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        tmp_path.replace(path)
@@ -0,0 +1,168 @@
+import asyncio
+import re
+import time
+from email.utils import parsedate_to_datetime
+from typing import Mapping
+
+
+class AdaptiveLimiter:
+    """
+    AIMD controller of the concurrency and request rate sent to a provider.
+    The configured values are ceilings: limits are halved on 429 / overload
+    responses, trimmed when latency climbs well above the best observed, and
+    grow back additively while requests succeed.
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int,
+        max_rate: float,
+        time_period: float,
+        adaptive: bool = True,
+        latency_factor: float = 3.0,
+    ) -> None:
+        self.max_concurrent = max(1, max_concurrent)
+        # requests per second
+        self.max_rate = max_rate / time_period
+        self.min_rate = self.max_rate / 100
+        self.adaptive = adaptive
+        self.latency_factor = latency_factor
+
+        self.concurrency = float(self.max_concurrent)
+        self.rate = self.max_rate
+        self.in_flight = 0
+        self.throttled = 0
+
+        self._cond = asyncio.Condition()
+        self._next_start = 0.0
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._latency: float | None = None
+        self._best_latency: float | None = None
+
+    @property
+    def limits(self) -> str:
+        return (
+            f"concurrency {int(self.concurrency)}/{self.max_concurrent}, "
+            f"rate {self.rate * 60:.0f}/{self.max_rate * 60:.0f} per min, "
+            f"throttled {self.throttled}"
+        )
+
+    async def __aenter__(self) -> "AdaptiveLimiter":
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self.release()
+
+    async def acquire(self) -> None:
+        async with self._cond:
+            await self._cond.wait_for(
+                lambda: self.in_flight < max(1, int(self.concurrency))
+            )
+            self.in_flight += 1
+            # space request starts 1 / rate apart and honour Retry-After pauses
+            now = time.monotonic()
+            start = max(now, self._next_start, self._paused_until)
+            self._next_start = start + 1 / self.rate
+        if start > now:
+            try:
+                await asyncio.sleep(start - now)
+            except BaseException:
+                # cancelled while waiting for its start, give the slot back
+                await self.release()
+                raise
+
+    async def release(self) -> None:
+        async with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def on_success(self, latency: float, headers: Mapping[str, str] | None = None) -> None:
+        if headers is not None:
+            self._apply_headers(headers)
+        if not self.adaptive:
+            return
+
+        self._latency = (
+            latency if self._latency is None else 0.9 * self._latency + 0.1 * latency
+        )
+        self._best_latency = (
+            latency if self._best_latency is None else min(self._best_latency, latency)
+        )
+        if self._latency > self.latency_factor * self._best_latency:
+            # provider is queueing our requests, back off gently
+            self._decrease(0.9)
+            return
+
+        self.concurrency = min(
+            self.max_concurrent, self.concurrency + 1 / self.concurrency
+        )
+        self.rate = min(
+            self.max_rate, self.rate + self.max_rate / 100 / max(1.0, self.concurrency)
+        )
+
+    def on_throttle(self, headers: Mapping[str, str] | None = None) -> None:
+        self.throttled += 1
+        retry_after = self.parse_retry_after(headers) if headers is not None else None
+        if retry_after:
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+        if self.adaptive:
+            self._decrease(0.5)
+
+    def _decrease(self, factor: float) -> None:
+        # many requests of the same window fail together, count them once
+        now = time.monotonic()
+        if now - self._last_decrease < max(1.0, self._latency or 0.0):
+            return
+        self._last_decrease = now
+        self.concurrency = max(1.0, self.concurrency * factor)
+        self.rate = max(self.min_rate, self.rate * factor)
+
+    def _apply_headers(self, headers: Mapping[str, str]) -> None:
+        remaining = headers.get("x-ratelimit-remaining-requests")
+        reset = headers.get("x-ratelimit-reset-requests")
+        if remaining is not None and reset is not None:
+            try:
+                exhausted = int(float(remaining)) <= 0
+            except ValueError:
+                return
+            if exhausted:
+                self._paused_until = max(
+                    self._paused_until, time.monotonic() + self.parse_duration(reset)
+                )
+
+    @staticmethod
+    def parse_duration(value: str) -> float:
+        """
+        Parses reset durations such as "20ms", "1s", "6m0s" or "1.5".
+        """
+        units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+        parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value)
+        if parts:
+            return sum(float(number) * units[unit] for number, unit in parts)
+        try:
+            return float(value)
+        except ValueError:
+            return 0.0
+
+    @staticmethod
+    def parse_retry_after(headers: Mapping[str, str]) -> float | None:
+        retry_after_ms = headers.get("retry-after-ms")
+        if retry_after_ms is not None:
+            try:
+                return float(retry_after_ms) / 1000
+            except ValueError:
+                pass
+
+        retry_after = headers.get("retry-after")
+        if retry_after is None:
+            return None
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
@@ -1,6 +1,7 @@
 from pathlib import Path
 
 import pandas as pd
+import pyarrow.parquet as pq
 
 
 class DataLoader:
@@ -13,8 +14,21 @@ class DataLoader:
             raise Exception("Error:", e)
 
     @staticmethod
-    def csv_to_df(path: str | Path):
+    def csv_to_df(path: str | Path, dtype: type | None = None):
         try:
-            return pd.read_csv(path)
+            return pd.read_csv(path, dtype=dtype)
+        except Exception as e:
+            raise Exception("Error:", e)
+
+    @staticmethod
+    def parquet_to_df(path: str | Path, columns: list[str] | None = None):
+        """
+        Reads a Parquet file, loading only the listed columns that it has.
+        """
+        try:
+            if columns is not None:
+                available = set(pq.read_schema(path).names)
+                columns = [col for col in columns if col in available]
+            return pd.read_parquet(path, columns=columns)
         except Exception as e:
             raise Exception("Error:", e)
\ No newline at end of file
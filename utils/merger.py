@@ -1,10 +1,107 @@
+import hashlib
+import json
+import os
 import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
+from typing import Iterator, Literal, NamedTuple
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from tqdm import tqdm
 
 
+class MergeOutcome(NamedTuple):
+    filename: str
+    status: Literal["unchanged", "appended", "merged", "failed"]
+    # source states to record in the manifest, None to retry next run
+    sources: dict[str, dict] | None
+    messages: list[str]
+    # merged file of the group, written or left as it was
+    output: Path
+
+
+class _RowFingerprints:
+    """
+    Set of 64-bit row hashes kept in sorted numpy arrays, 8 bytes per row
+    instead of a Python int in a set.
+    """
+
+    def __init__(self) -> None:
+        self._merged = np.empty(0, dtype=np.uint64)
+        # recently added, merged into _merged once they add up
+        self._recent: list[np.ndarray] = []
+
+    @staticmethod
+    def _contains(sorted_hashes: np.ndarray, hashes: np.ndarray) -> np.ndarray:
+        positions = np.searchsorted(sorted_hashes, hashes)
+        positions[positions == len(sorted_hashes)] = 0
+        return (
+            sorted_hashes[positions] == hashes
+            if len(sorted_hashes)
+            else np.zeros(len(hashes), dtype=bool)
+        )
+
+    def add_new(self, hashes: np.ndarray) -> np.ndarray:
+        """
+        Adds hashes and returns the mask of rows not seen before, the first
+        of repeated hashes within the batch included.
+        """
+        new = ~pd.Series(hashes).duplicated().to_numpy()
+        for sorted_hashes in [self._merged, *self._recent]:
+            new &= ~self._contains(sorted_hashes, hashes)
+        self._recent.append(np.sort(hashes[new]))
+        recent_size = sum(len(r) for r in self._recent)
+        if len(self._recent) > 8 or recent_size > len(self._merged) // 4:
+            self._merged = np.sort(np.concatenate([self._merged, *self._recent]))
+            self._recent = []
+        return new
+
+
+class _ChunkWriter:
+    """
+    Appends merged chunks to a CSV or Parquet output, writing the same file
+    _write_output would write for the whole frame. Chunks go to a temporary
+    file that replaces path on close, as path may be one of the inputs.
+    """
+
+    def __init__(self, path: Path, columns: list[str]) -> None:
+        self.path = path
+        self.tmp_path = path.with_name(path.name + ".tmp")
+        self.tmp_path.unlink(missing_ok=True)
+        self.columns = columns
+        self._header = True
+        self._writer: pq.ParquetWriter | None = None
+
+    def write(self, chunk: pd.DataFrame) -> None:
+        if self.path.suffix != ".parquet":
+            chunk.to_csv(self.tmp_path, mode="a", header=self._header, index=False)
+            self._header = False
+            return
+
+        if "Date2" in chunk.columns and "Time" in chunk.columns:
+            chunk = chunk.assign(Timestamp=DataManager._parse_timestamp(chunk))
+        if self._writer is None:
+            fields = [pa.field(col, pa.string()) for col in self.columns]
+            if "Timestamp" in chunk.columns:
+                fields.append(pa.field("Timestamp", pa.timestamp("ns")))
+            self._writer = pq.ParquetWriter(self.tmp_path, pa.schema(fields))
+        self._writer.write_table(
+            pa.Table.from_pandas(chunk, schema=self._writer.schema, preserve_index=False)
+        )
+
+    def close(self) -> None:
+        if self._writer is None and (self._header or self.path.suffix == ".parquet"):
+            # no rows at all, still leave a file with the columns
+            self.write(pd.DataFrame(columns=self.columns, dtype=object))
+        if self._writer is not None:
+            self._writer.close()
+        self.tmp_path.replace(self.path)
+
+
 class DataManager:
 
     def __init__(self, base_path: str) -> None:
@@ -26,14 +123,61 @@ class DataManager:
         else:
             df.to_csv(dst_path, index=False)
 
+    MANIFEST_NAME = ".merge_manifest.json"
+    NATURE_MANIFEST = "natures.json"
+    # file formats a group can be merged to
+    OUTPUT_SUFFIXES = [".csv", ".parquet"]
+    # columns added by the merge itself, dropped before re-merging an output
+    DERIVED_COLUMNS = ["temp_sort_date", "temp_sort_time", "Timestamp"]
+    # sort key of rows whose Date2 / Time does not parse, they sort last
+    KEY_MISSING = np.iinfo(np.int64).max
+
     def merge_csv_files(
         self,
         src: str = "merge_src",
         dst: str = "merge_dst",
+        full: bool = False,
+        workers: int = 1,
+        fmt: Literal["csv", "parquet"] = "csv",
+        chunk_rows: int | None = None,
     ):
+        """
+        Merges every group, see iter_merge_csv_files.
+        """
+        for _ in self.iter_merge_csv_files(src, dst, full, workers, fmt, chunk_rows):
+            pass
+
+    def iter_merge_csv_files(
+        self,
+        src: str = "merge_src",
+        dst: str = "merge_dst",
+        full: bool = False,
+        workers: int = 1,
+        fmt: Literal["csv", "parquet"] = "csv",
+        chunk_rows: int | None = None,
+    ) -> Iterator[MergeOutcome]:
         """
         Scans subfolders in src, merges CSVs with the same filename,
         sorts by Date2/Time, removes duplicates, and saves to dst.
+
+        A manifest of the source files (size, mtime, content hash) is kept in
+        dst, so groups whose sources did not change are skipped and groups
+        that only gained new files are merged into their existing output.
+        Pass full=True to ignore the manifest and re-merge every group.
+        With workers > 1 groups are merged in a pool of worker processes.
+
+        fmt="parquet" saves each group as Parquet with an extra typed
+        Timestamp column parsed from Date2/Time, for a faster hand-off to
+        the Preprocessor. The output of a group in the other format, left by
+        an earlier run, is deleted so only one of them gets organized.
+
+        With chunk_rows, groups are merged out of core in chunks of that
+        many rows (see _external_merge), so memory stays bounded however
+        large a group is.
+
+        The outcome of each group is yielded as soon as it is merged, so
+        later stages can start on it; the manifest and the report are
+        written once the last group is done.
         """
 
         # 1. Setup Paths
@@ -68,109 +212,536 @@ class DataManager:
                     files_map[filename] = []
                 files_map[filename].append(file_path)
 
+        manifest_path = dst_path / self.MANIFEST_NAME
+        manifest = {} if full else self._load_manifest(manifest_path)
+        new_manifest: dict[str, dict[str, dict]] = {}
+        counts = {"unchanged": 0, "appended": 0, "merged": 0, "failed": 0}
+        report: list[str] = []
+
         # 3. Process each unique filename
-        for filename, file_paths in tqdm(files_map.items(), desc="Merging Files"):
+        jobs = [
+            (
+                filename,
+                file_paths,
+                dst_path / (Path(filename).stem + "." + fmt),
+                manifest.get(filename, {}),
+                chunk_rows,
+            )
+            for filename, file_paths in files_map.items()
+        ]
+        if workers > 1 and len(jobs) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(self._merge_group, *job) for job in jobs]
+                outcomes = (future.result() for future in as_completed(futures))
+                for outcome in tqdm(outcomes, total=len(jobs), desc="Merging Files"):
+                    self._collect(outcome, new_manifest, counts, report)
+                    yield outcome
+        else:
+            for job in tqdm(jobs, desc="Merging Files"):
+                outcome = self._merge_group(*job)
+                self._collect(outcome, new_manifest, counts, report)
+                yield outcome
+
+        self._save_manifest(manifest_path, new_manifest)
+        if report:
+            print(f"Merge report ({len(report)} issues):")
+            for line in report:
+                print(f"  {line}")
+        print(
+            f"Merge complete. {counts['unchanged']} groups unchanged, "
+            f"{counts['appended']} appended, {counts['merged']} fully merged, "
+            f"{counts['failed']} failed."
+        )
+
+    @staticmethod
+    def _collect(
+        outcome: MergeOutcome,
+        manifest: dict[str, dict[str, dict]],
+        counts: dict[str, int],
+        report: list[str],
+    ) -> None:
+        counts[outcome.status] += 1
+        report.extend(outcome.messages)
+        # unreadable parts are left out so the group is retried next run
+        if outcome.sources is not None:
+            manifest[outcome.filename] = outcome.sources
+
+    @staticmethod
+    def _merge_group(
+        filename: str,
+        file_paths: list[Path],
+        output_file_path: Path,
+        previous: dict[str, dict],
+        chunk_rows: int | None = None,
+    ) -> MergeOutcome:
+        """
+        Merges one filename group. Runs in a worker process when merge
+        workers are used, so it only returns data and never prints.
+        """
+        messages: list[str] = []
+        try:
+            sources = DataManager._file_states(file_paths, previous)
+
+            current_hashes = {p: state["sha1"] for p, state in sources.items()}
+            previous_hashes = {p: state["sha1"] for p, state in previous.items()}
+            if output_file_path.exists() and current_hashes == previous_hashes:
+                DataManager._drop_other_formats(output_file_path)
+                return MergeOutcome(
+                    filename, "unchanged", sources, messages, output_file_path
+                )
+
+            # Append-only: every previously merged part is unchanged, so
+            # the existing output stands in for them
+            append_only = (
+                output_file_path.exists()
+                and bool(previous_hashes)
+                and all(current_hashes.get(p) == h for p, h in previous_hashes.items())
+            )
+            if chunk_rows:
+                parts = file_paths
+                if append_only:
+                    parts = [fp for fp in file_paths if str(fp) not in previous]
+                status = "appended" if append_only else "merged"
+                read_ok = DataManager._external_merge(
+                    parts,
+                    output_file_path if append_only else None,
+                    output_file_path,
+                    filename,
+                    chunk_rows,
+                    messages,
+                )
+                if read_ok is None:
+                    return MergeOutcome(
+                        filename, status, None, messages, output_file_path
+                    )
+                DataManager._drop_other_formats(output_file_path)
+                return MergeOutcome(
+                    filename,
+                    status,
+                    sources if read_ok else None,
+                    messages,
+                    output_file_path,
+                )
+
+            if append_only:
+                new_parts = [fp for fp in file_paths if str(fp) not in previous]
+                dfs, read_ok = DataManager._read_csv_parts(new_parts, messages)
+                existing_df = DataManager._read_output(output_file_path)
+                existing_df.drop(
+                    columns=DataManager.DERIVED_COLUMNS, errors="ignore", inplace=True
+                )
+                dfs.insert(0, existing_df)
+                status = "appended"
+            else:
+                dfs, read_ok = DataManager._read_csv_parts(file_paths, messages)
+                status = "merged"
+
+            if not dfs:
+                return MergeOutcome(
+                    filename, status, None, messages, output_file_path
+                )
+
+            # Merge all dataframes for this filename
+            merged_df = pd.concat(dfs, ignore_index=True)
+            merged_df = DataManager._dedupe_and_sort(merged_df, filename, messages)
+
+            # 6. Save to 'merged' folder
+            DataManager._write_output(merged_df, output_file_path)
+            DataManager._drop_other_formats(output_file_path)
+
+            return MergeOutcome(
+                filename,
+                status,
+                sources if read_ok else None,
+                messages,
+                output_file_path,
+            )
+
+        except Exception as e:
+            messages.append(f"Failed to process group '{filename}': {e}")
+            return MergeOutcome(filename, "failed", None, messages, output_file_path)
+
+    @staticmethod
+    def _read_output(path: Path) -> pd.DataFrame:
+        if path.suffix == ".parquet":
+            return pd.read_parquet(path)
+        return pd.read_csv(path, dtype=str)
+
+    @staticmethod
+    def _write_output(merged_df: pd.DataFrame, path: Path) -> None:
+        if path.suffix != ".parquet":
+            merged_df.to_csv(path, index=False)
+            return
 
+        # the typed Timestamp supersedes the sort helpers
+        merged_df = merged_df.drop(
+            columns=["temp_sort_date", "temp_sort_time"], errors="ignore"
+        )
+        if "Date2" in merged_df.columns and "Time" in merged_df.columns:
+            merged_df = merged_df.assign(
+                Timestamp=DataManager._parse_timestamp(merged_df)
+            )
+        merged_df.to_parquet(path, index=False)
+
+    @staticmethod
+    def _parse_timestamp(df: pd.DataFrame) -> pd.Series:
+        # typed Date2 + Time for readers of the Parquet output, NaT if unparsable
+        date = pd.to_datetime(df["Date2"], dayfirst=True, errors="coerce")
+        return date + pd.to_timedelta(df["Time"], errors="coerce")
+
+    @staticmethod
+    def _drop_other_formats(path: Path) -> None:
+        for suffix in DataManager.OUTPUT_SUFFIXES:
+            if suffix != path.suffix:
+                path.with_suffix(suffix).unlink(missing_ok=True)
+
+    @staticmethod
+    def _read_csv_parts(
+        file_paths: list[Path], messages: list[str]
+    ) -> tuple[list[pd.DataFrame], bool]:
+        """
+        Reads every part of a group. Returns the frames and whether all
+        parts could be read; problems are appended to messages.
+        """
+        dfs = []
+        read_ok = True
+        for fp in file_paths:
             try:
-                # List to hold dataframes for this specific filename
-                dfs = []
-
-                # Read all files with this name
-                for fp in file_paths:
-                    try:
-                        # Read CSV.
-                        # We read everything as strings initially to ensure we don't lose leading zeros
-                        # or have pandas guess types incorrectly before merging.
-                        df = pd.read_csv(fp, dtype=str)
-                        dfs.append(df)
-                    except pd.errors.EmptyDataError:
-                        tqdm.write(f"Warning: Skipped empty file {fp}")
-                    except Exception as e:
-                        tqdm.write(f"Error reading {fp}: {e}")
-
-                if not dfs:
-                    continue
-
-                # Merge all dataframes for this filename
-                merged_df = pd.concat(dfs, ignore_index=True)
-
-                # 4. Remove Duplicates
-                # Keeps the first occurrence, drops subsequent identical rows
-                merged_df.drop_duplicates(inplace=True)
-
-                # 5. Sort by 'Date2' and 'Time'
-                # Check if columns exist before sorting
-                if "Date2" in merged_df.columns and "Time" in merged_df.columns:
-
-                    # --- FIX APPLIED HERE ---
-                    # Added dayfirst=True to handle dd/mm/yyyy format correctly
-                    merged_df["temp_sort_date"] = pd.to_datetime(
-                        merged_df["Date2"], dayfirst=True, errors="coerce"
-                    )
+                # Read CSV.
+                # We read everything as strings initially to ensure we don't lose leading zeros
+                # or have pandas guess types incorrectly before merging.
+                df = pd.read_csv(fp, dtype=str)
+                dfs.append(df)
+            except pd.errors.EmptyDataError:
+                messages.append(f"Warning: Skipped empty file {fp}")
+            except Exception as e:
+                messages.append(f"Error reading {fp}: {e}")
+                read_ok = False
+        return dfs, read_ok
+
+    @staticmethod
+    def _dedupe_and_sort(
+        merged_df: pd.DataFrame, filename: str, messages: list[str]
+    ) -> pd.DataFrame:
+        # 4. Remove Duplicates
+        # Keeps the first occurrence, drops subsequent identical rows
+        merged_df.drop_duplicates(inplace=True)
+
+        # 5. Sort by 'Date2' and 'Time'
+        # Check if columns exist before sorting
+        if "Date2" in merged_df.columns and "Time" in merged_df.columns:
+
+            # --- FIX APPLIED HERE ---
+            # Added dayfirst=True to handle dd/mm/yyyy format correctly
+            merged_df["temp_sort_date"] = pd.to_datetime(
+                merged_df["Date2"], dayfirst=True, errors="coerce"
+            )
+
+            # Handle Time parsing
+            merged_df["temp_sort_time"] = pd.to_datetime(
+                merged_df["Time"], format="%H:%M:%S", errors="coerce"
+            ).dt.time
+
+            # Sort
+            # We sort by the temp columns if created
+            if "temp_sort_date" in merged_df.columns and pd.api.types.is_datetime64_dtype(
+                merged_df["temp_sort_date"]
+            ):
+                merged_df.sort_values(
+                    by=["temp_sort_date", "temp_sort_time"],
+                    ascending=[True, True],
+                    inplace=True,
+                )
+                # Drop temp columns so they don't appear in the final file
+                merged_df.drop(
+                    columns=["temp_sort_date", "temp_sort_time"], inplace=True
+                )
+            else:
+                # Fallback to string sorting if datetime conversion failed completely
+                merged_df.sort_values(
+                    by=["Date2", "Time"], ascending=[True, True], inplace=True
+                )
+        else:
+            messages.append(
+                f"Notice: '{filename}' missing 'Date2' or 'Time' columns. Saved without specific sort."
+            )
+        return merged_df
 
-                    # Handle Time parsing
-                    merged_df["temp_sort_time"] = pd.to_datetime(
-                        merged_df["Time"], format="%H:%M:%S", errors="coerce"
-                    ).dt.time
-
-                    # Sort
-                    # We sort by the temp columns if created
-                    if (
-                        "temp_sort_date" in merged_df.columns
-                        and merged_df.dtypes["temp_sort_date"] == pd.Timestamp
-                    ):
-                        merged_df.sort_values(
-                            by=["temp_sort_date", "temp_sort_time"],
-                            ascending=[True, True],
-                            inplace=True,
+    @staticmethod
+    def _sort_keys(chunk: pd.DataFrame) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Date2 and Time parsed like _dedupe_and_sort does, as int64 keys
+        (nanoseconds) with unparsable values sorting last.
+        """
+        dates = pd.to_datetime(chunk["Date2"], dayfirst=True, errors="coerce")
+        times = pd.to_datetime(chunk["Time"], format="%H:%M:%S", errors="coerce")
+        times = times - times.dt.normalize()
+        return (
+            dates.to_numpy("int64", na_value=DataManager.KEY_MISSING),
+            times.to_numpy("int64", na_value=DataManager.KEY_MISSING),
+        )
+
+    @staticmethod
+    def _read_chunks(path: Path, chunk_rows: int) -> Iterator[pd.DataFrame]:
+        if path.suffix == ".parquet":
+            for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows):
+                yield batch.to_pandas()
+            return
+        with pd.read_csv(path, dtype=str, chunksize=chunk_rows) as reader:
+            yield from reader
+
+    @staticmethod
+    def _read_header(path: Path) -> list[str]:
+        if path.suffix == ".parquet":
+            return pq.read_schema(path).names
+        return list(pd.read_csv(path, dtype=str, nrows=0).columns)
+
+    @staticmethod
+    def _external_merge(
+        parts: list[Path],
+        existing: Path | None,
+        output_file_path: Path,
+        filename: str,
+        chunk_rows: int,
+        messages: list[str],
+    ) -> bool | None:
+        """
+        Out-of-core concat + _dedupe_and_sort + _write_output of a group.
+        Every part is read chunk by chunk, rows already seen are dropped by
+        their 64-bit hash and each chunk is sorted into a run on disk. A
+        chunk that starts at or after the end of the current run extends it,
+        so the mostly sorted exports give few runs. The runs are then k-way
+        merged on the parsed Date2/Time key into the output. existing is the
+        previous output, merged first in append-only mode.
+
+        Returns whether every part could be read, or None if none could.
+        """
+        # 1. Columns of all parts, in order of appearance like pd.concat
+        sources = ([existing] if existing is not None else []) + parts
+        columns: list[str] = []
+        readable: list[Path] = []
+        read_ok = True
+        for fp in sources:
+            try:
+                header = DataManager._read_header(fp)
+            except pd.errors.EmptyDataError:
+                messages.append(f"Warning: Skipped empty file {fp}")
+                continue
+            except Exception as e:
+                messages.append(f"Error reading {fp}: {e}")
+                read_ok = False
+                continue
+            if fp is existing:
+                header = [c for c in header if c not in DataManager.DERIVED_COLUMNS]
+            columns += [c for c in header if c not in columns]
+            readable.append(fp)
+        if not readable:
+            return None
+
+        sort = "Date2" in columns and "Time" in columns
+        if not sort:
+            messages.append(
+                f"Notice: '{filename}' missing 'Date2' or 'Time' columns. Saved without specific sort."
+            )
+
+        output = _ChunkWriter(output_file_path, columns)
+        fingerprints = _RowFingerprints()
+        with tempfile.TemporaryDirectory(dir=output_file_path.parent) as tmp_dir:
+            # 2. Deduplicated, sorted runs
+            run_schema = pa.schema(
+                [pa.field(col, pa.string()) for col in columns]
+                + [pa.field("_date", pa.int64()), pa.field("_time", pa.int64())]
+            )
+            runs: list[Path] = []
+            writer: pq.ParquetWriter | None = None
+            last_key: tuple[int, int] | None = None
+            for fp in readable:
+                try:
+                    for chunk in DataManager._read_chunks(fp, chunk_rows):
+                        chunk = chunk.reindex(columns=columns)
+                        hashes = pd.util.hash_pandas_object(chunk, index=False)
+                        chunk = chunk[fingerprints.add_new(hashes.to_numpy())]
+                        if chunk.empty:
+                            continue
+                        if not sort:
+                            output.write(chunk)
+                            continue
+
+                        dates, times = DataManager._sort_keys(chunk)
+                        order = np.lexsort((times, dates))
+                        chunk = chunk.iloc[order].assign(
+                            _date=dates[order], _time=times[order]
                         )
-                        # Drop temp columns so they don't appear in the final file
-                        merged_df.drop(
-                            columns=["temp_sort_date", "temp_sort_time"], inplace=True
+                        first_key = (dates[order[0]], times[order[0]])
+                        if writer is None or last_key is None or first_key < last_key:
+                            if writer is not None:
+                                writer.close()
+                            runs.append(Path(tmp_dir) / f"run{len(runs)}.parquet")
+                            writer = pq.ParquetWriter(runs[-1], run_schema)
+                        writer.write_table(
+                            pa.Table.from_pandas(
+                                chunk, schema=run_schema, preserve_index=False
+                            )
                         )
+                        last_key = (dates[order[-1]], times[order[-1]])
+                except pd.errors.EmptyDataError:
+                    messages.append(f"Warning: Skipped empty file {fp}")
+                except Exception as e:
+                    messages.append(f"Error reading {fp}: {e}")
+                    read_ok = False
+            if writer is not None:
+                writer.close()
+
+            # 3. k-way merge of the runs
+            if runs:
+                batch_rows = max(1_000, chunk_rows // len(runs))
+                for chunk in DataManager._merge_runs(runs, batch_rows):
+                    output.write(chunk.drop(columns=["_date", "_time"]))
+        output.close()
+        return read_ok
+
+    @staticmethod
+    def _merge_runs(runs: list[Path], batch_rows: int) -> Iterator[pd.DataFrame]:
+        """
+        Merges sorted runs by their (_date, _time) key, holding one batch
+        per run. Each step emits every buffered row up to the smallest last
+        key of the runs that still have batches on disk; rows with equal
+        keys keep run order, so the result is a stable sort.
+        """
+        batches = [
+            pq.ParquetFile(run).iter_batches(batch_size=batch_rows) for run in runs
+        ]
+        buffers: list[pd.DataFrame | None] = [None] * len(runs)
+        # runs whose batches are not all buffered yet
+        pending = [True] * len(runs)
+
+        while True:
+            for i, buffer in enumerate(buffers):
+                if pending[i] and (buffer is None or buffer.empty):
+                    batch = next(batches[i], None)
+                    if batch is None:
+                        pending[i] = False
+                        buffers[i] = None
                     else:
-                        # Fallback to string sorting if datetime conversion failed completely
-                        merged_df.sort_values(
-                            by=["Date2", "Time"], ascending=[True, True], inplace=True
-                        )
+                        buffers[i] = batch.to_pandas()
+            if not any(b is not None and not b.empty for b in buffers):
+                return
+
+            # rows past the frontier may still have smaller keys on disk
+            limits = [
+                (int(b["_date"].iat[-1]), int(b["_time"].iat[-1]), i)
+                for i, b in enumerate(buffers)
+                if pending[i] and b is not None
+            ]
+            frontier = min(limits) if limits else None
+            parts = []
+            for i, buffer in enumerate(buffers):
+                if buffer is None or buffer.empty:
+                    continue
+                if frontier is None:
+                    take = len(buffer)
                 else:
-                    tqdm.write(
-                        f"Notice: '{filename}' missing 'Date2' or 'Time' columns. Saved without specific sort."
-                    )
-
-                # 6. Save to 'merged' folder
-                output_file_path = dst_path / filename
-                merged_df.to_csv(output_file_path, index=False)
-
-            except Exception as e:
-                tqdm.write(f"Failed to process group '{filename}': {e}")
-
-        print("Merge complete.")
+                    date, time, first_run = frontier
+                    dates, times = buffer["_date"], buffer["_time"]
+                    before = (dates < date) | ((dates == date) & (times < time))
+                    if i <= first_run:
+                        # every row of this run with the frontier key is buffered
+                        before |= (dates == date) & (times == time)
+                    take = int(before.sum())
+                parts.append(buffer.iloc[:take])
+                buffers[i] = buffer.iloc[take:]
+
+            merged = pd.concat(parts, ignore_index=True)
+            order = np.lexsort((merged["_time"].to_numpy(), merged["_date"].to_numpy()))
+            yield merged.iloc[order]
+
+    @staticmethod
+    def _file_states(
+        file_paths: list[Path], previous: dict[str, dict]
+    ) -> dict[str, dict]:
+        """
+        Size, mtime and content hash of each file. The hash of a file whose
+        size and mtime match the previous manifest is reused, not recomputed.
+        """
+        states: dict[str, dict] = {}
+        for fp in file_paths:
+            stat = fp.stat()
+            old = previous.get(str(fp))
+            if old and old["size"] == stat.st_size and old["mtime"] == stat.st_mtime_ns:
+                sha1 = old["sha1"]
+            else:
+                sha1 = hashlib.sha1(fp.read_bytes()).hexdigest()
+            states[str(fp)] = {
+                "size": stat.st_size,
+                "mtime": stat.st_mtime_ns,
+                "sha1": sha1,
+            }
+        return states
+
+    @staticmethod
+    def _load_manifest(path: Path) -> dict:
+        try:
+            return json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, json.JSONDecodeError):
+            return {}
+
+    @staticmethod
+    def _save_manifest(path: Path, manifest: dict) -> None:
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(manifest, indent=1), encoding="utf-8")
+        tmp_path.replace(path)
 
     def organize_csv_by_nature(
         self,
         src: str,
         dst: str,
         group_nature: str,
+        mode: Literal["copy", "link", "manifest"] = "copy",
     ):
+        """
+        Sorts merged group files into one folder per group nature.
+
+        mode="copy" copies the files, mode="link" hardlinks them (symlink,
+        then copy as fallbacks) and mode="manifest" only writes a
+        nature -> files manifest in dst that Preprocessor reads straight
+        from src.
+        """
 
         src_path = self.base_path / src
         dst_path = self.base_path / dst
 
-        files = list(src_path.rglob("*.csv"))
+        files = list(src_path.rglob("*.csv")) + list(src_path.rglob("*.parquet"))
 
-        if group_nature.endswith(".csv"):
-            nature_df = pd.read_csv(group_nature, dtype=str)
-        elif group_nature.endswith(".xlsx"):
-            nature_df = pd.read_excel(group_nature, dtype=str)
+        # matched on the file stem so merged CSV and Parquet files both resolve
+        nature_dict = self.read_natures(group_nature)
 
-        nature_df["filename"] = nature_df["gus_id"] + ".csv"
-        nature_dict = dict(
-            zip(nature_df["filename"], nature_df["group_nature"])
-        )  # cast(list[dict[str, str]], nature_df.to_dict(orient="records"))
+        manifest_path = dst_path / self.NATURE_MANIFEST
+        if mode == "manifest":
+            groups: dict[str, list[str]] = {}
+            for file in files:
+                nature = nature_dict.get(file.stem, "")
+                if len(nature) > 1:
+                    groups.setdefault(nature, []).append(
+                        file.relative_to(src_path).as_posix()
+                    )
+            dst_path.mkdir(exist_ok=True, parents=True)
+            manifest = {
+                # relative, so the data folder can be moved as a whole
+                "source": Path(os.path.relpath(src_path, dst_path)).as_posix(),
+                "natures": groups,
+            }
+            self._save_manifest(manifest_path, manifest)
+            print(
+                f"Wrote nature manifest of {sum(len(g) for g in groups.values())} "
+                f"groups in {len(groups)} natures to '{dst}'"
+            )
+            return
+
+        # a manifest would take precedence over the folders written below
+        manifest_path.unlink(missing_ok=True)
 
         # create folders by nature
-        natures: list[str] = list(nature_df["group_nature"].astype(str).unique())
+        natures: list[str] = [str(n) for n in dict.fromkeys(nature_dict.values())]
         nature_paths = {}
         for nature in natures:
             folder = dst_path / nature
@@ -180,7 +751,7 @@ class DataManager:
             nature_paths[nature] = dst_path / nature
 
         for file in files:
-            nature = nature_dict.get(file.name, "")
+            nature = nature_dict.get(file.stem, "")
             # nature = next(
             #     (
             #         item["group_nature"]
@@ -190,5 +761,56 @@ class DataManager:
             #     "",
             # )
             if len(nature) > 1:
-                dest = dst_path / nature
-                shutil.copy2(file, dest)
\ No newline at end of file
+                self.place_file(file, dst_path / nature, mode)
+
+    @staticmethod
+    def read_natures(group_nature: str) -> dict[str, str]:
+        """
+        Reads the gus_id -> group_nature table from a .csv or .xlsx file.
+        """
+        if group_nature.endswith(".csv"):
+            nature_df = pd.read_csv(group_nature, dtype=str)
+        elif group_nature.endswith(".xlsx"):
+            nature_df = pd.read_excel(group_nature, dtype=str)
+
+        return dict(
+            zip(nature_df["gus_id"], nature_df["group_nature"])
+        )  # cast(list[dict[str, str]], nature_df.to_dict(orient="records"))
+
+    @staticmethod
+    def place_file(
+        file: Path, dest: Path, mode: Literal["copy", "link", "manifest"] = "copy"
+    ) -> Path:
+        """
+        Puts one merged file into its nature folder dest and returns the
+        path to load it from; in manifest mode that is the file itself.
+        """
+        if mode == "manifest":
+            return file
+        dest.mkdir(exist_ok=True, parents=True)
+        # a copy of the group in the other format would be loaded as well
+        DataManager._drop_other_formats(dest / file.name)
+        target = dest / file.name
+        if mode == "link":
+            DataManager._link(file, target)
+        else:
+            # target may be a link to file left by a link run
+            target.unlink(missing_ok=True)
+            shutil.copy2(file, target)
+        return target
+
+    @staticmethod
+    def _link(src: Path, dest: Path) -> None:
+        """
+        Hardlinks src to dest, falling back to a symlink (e.g. across drives)
+        and then to a copy.
+        """
+        dest.unlink(missing_ok=True)
+        try:
+            os.link(src, dest)
+        except OSError:
+            try:
+                dest.symlink_to(src.resolve())
+            except OSError:
+                dest.unlink(missing_ok=True)
+                shutil.copy2(src, dest)
\ No newline at end of file
@@ -0,0 +1,88 @@
+import asyncio
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterator
+
+from utils.queues import STOP, Failure
+
+
+class StagePipeline:
+    """
+    Passes the items of a blocking source through a chain of async stages
+    connected by bounded queues. Every stage has its own workers and hands an
+    item on as soon as it is done with it, so a slow stage starts on the
+    first item instead of waiting for the earlier stages to finish them all.
+    """
+
+    def __init__(self, source: Iterator[Any], queue_size: int = 2) -> None:
+        # advanced in a thread, it may block on CPU or disk work
+        self.source = source
+        self.queue_size = max(1, queue_size)
+        # (name, func, workers); func returns None to drop an item
+        self.stages: list[tuple[str, Callable[[Any], Awaitable[Any]], int]] = []
+
+    def stage(
+        self, name: str, func: Callable[[Any], Awaitable[Any]], workers: int = 1
+    ) -> "StagePipeline":
+        self.stages.append((name, func, max(1, workers)))
+        return self
+
+    async def run(self) -> AsyncIterator[Any]:
+        """
+        Yields the results of the last stage in completion order. The first
+        error of any stage stops the whole pipeline and is raised here.
+        """
+        queues: list[asyncio.Queue] = [
+            asyncio.Queue(self.queue_size) for _ in range(len(self.stages) + 1)
+        ]
+        done = queues[-1]
+
+        async def feed() -> None:
+            try:
+                while True:
+                    item = await asyncio.to_thread(next, self.source, STOP)
+                    if item is STOP:
+                        break
+                    await queues[0].put(item)
+            except Exception as e:
+                await done.put(Failure(e))
+                return
+            await queues[0].put(STOP)
+
+        async def work(stage: int, running: list[int]) -> None:
+            name, func, _ = self.stages[stage]
+            inbox, outbox = queues[stage], queues[stage + 1]
+            while True:
+                item = await inbox.get()
+                if item is STOP:
+                    # let the other workers of this stage see it too
+                    await inbox.put(STOP)
+                    break
+                try:
+                    result = await func(item)
+                except Exception as e:
+                    e.add_note(f"in pipeline stage '{name}'")
+                    await done.put(Failure(e))
+                    return
+                if result is not None:
+                    await outbox.put(result)
+            running[0] -= 1
+            if running[0] == 0:
+                await outbox.put(STOP)
+
+        tasks = [asyncio.create_task(feed())]
+        for stage, (_, _, workers) in enumerate(self.stages):
+            running = [workers]
+            tasks += [
+                asyncio.create_task(work(stage, running)) for _ in range(workers)
+            ]
+        try:
+            while True:
+                result = await done.get()
+                if result is STOP:
+                    break
+                if isinstance(result, Failure):
+                    raise result.error
+                yield result
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
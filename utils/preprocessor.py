@@ -1,18 +1,66 @@
+import json
+from collections import deque
+from concurrent.futures import (Executor, Future, ProcessPoolExecutor,
+                                ThreadPoolExecutor)
 from pathlib import Path
+from typing import Iterator, Literal, cast
 
 import pandas as pd
+import pandera.pandas as pa
+from pandera.config import ValidationDepth, config_context
 from pandera.typing import DataFrame
 from tqdm import tqdm
 
+from utils.keywords import KeywordIndex
 from utils.loader import DataLoader
+from utils.merger import DataManager
 from utils.validator import (ChatSchema, ChatSchemaRaw, KeywordSchema,
                              KeywordSchemaRaw)
 
+# full: raw + full schema per file and again after concat
+# once: each file validated once, the concatenated sheet is trusted
+# sampled: like once, but files longer than sample_rows only check a sample
+# schema: columns and dtypes only, no per-value checks
+ValidationPolicy = Literal["full", "once", "sampled", "schema"]
+# processes parse and validate in parallel, threads only overlap file I/O
+LoadExecutor = Literal["process", "thread"]
+
 
 class Preprocessor:
 
-    def __init__(self, base_path: str | Path) -> None:
+    # repeated values, stored once per distinct value in compact mode. Date2
+    # and Time stay text categoricals, not a parsed datetime: row keys and
+    # the output use the original strings, and WatermarkStore parses them
+    # itself where it compares times
+    CATEGORY_COLUMNS = [
+        "Source",
+        "Group",
+        "Date1",
+        "Date2",
+        "Time",
+        "userPhone",
+        "mediaType",
+    ]
+    # free text, stored in Arrow buffers instead of one Python object per cell
+    TEXT_COLUMNS = ["quotedMessage", "messageBody", "mediaCaption", "Reason"]
+    # files of a nature folder that are read as chats, anything else is skipped
+    CHAT_SUFFIXES = {".csv", ".parquet"}
+
+    def __init__(
+        self,
+        base_path: str | Path,
+        compact: bool = False,
+        validation: ValidationPolicy = "once",
+        sample_rows: int = 10_000,
+        load_workers: int = 1,
+        load_executor: LoadExecutor = "process",
+    ) -> None:
         self.base_path = Path(base_path)
+        self.compact = compact
+        self.validation = validation
+        self.sample_rows = sample_rows
+        self.load_workers = load_workers
+        self.load_executor = load_executor
 
     def get_keyword_df(self, file_path: str | Path) -> DataFrame[KeywordSchema] | None:
         keyword_path = self.base_path / file_path
@@ -41,6 +89,28 @@ class Preprocessor:
 
         return None
 
+    def get_keyword_index(
+        self, file_path: str | Path, cache_dir: str | Path = ".keyword_index"
+    ) -> KeywordIndex | None:
+        """
+        Returns the KeywordIndex of the keyword file, unpickled from cache_dir
+        when one was already built for the same file content.
+        """
+        keyword_path = self.base_path / file_path
+        index_path = KeywordIndex.cache_path(keyword_path, self.base_path / cache_dir)
+
+        index = KeywordIndex.load(index_path)
+        if index is not None:
+            return index
+
+        keyword_df = self.get_keyword_df(file_path)
+        if keyword_df is None:
+            return None
+
+        index = KeywordIndex(keyword_df)
+        index.save(index_path)
+        return index
+
     @staticmethod
     def _get_required_keyword(
         brand: str, req_prod: str, df: DataFrame[KeywordSchema]
@@ -50,62 +120,266 @@ class Preprocessor:
         return "|".join(keywords)
 
     def get_chat_df_dict(self, chat_folder: str) -> dict[str, DataFrame[ChatSchema]]:
-        sheets: dict[str, DataFrame[ChatSchema]] = {}
+        """
+        Loads one sheet per nature, from the nature subfolders of chat_folder
+        or, when the organizer wrote a nature manifest there, straight from
+        the merged files it lists.
+        """
+        return dict(self.iter_chat_dfs(chat_folder))
+
+    def chat_sheet_names(self, chat_folder: str) -> list[str]:
+        return list(self._chat_folders(chat_folder))
+
+    def iter_chat_dfs(
+        self, chat_folder: str, chunk_rows: int | None = None
+    ) -> Iterator[tuple[str, DataFrame[ChatSchema]]]:
+        """
+        Yields (sheet name, frame) one nature folder at a time, so only the
+        current sheet is held in memory. With chunk_rows, a sheet is yielded
+        as "<sheet>#1", "<sheet>#2", ... chunks of at most chunk_rows rows,
+        built while its files are read.
+        """
+        folders = self._chat_folders(chat_folder)
+        for name, files in tqdm(
+            folders.items(), desc="Loading CSV fils content", unit="files"
+        ):
+            tqdm.write("Reading folder: " + name)
+            dataframes = Preprocessor._iter_chat_df_files(
+                files,
+                self.validation,
+                self.sample_rows,
+                self.load_workers,
+                self.load_executor,
+            )
+            if not chunk_rows:
+                parts = list(dataframes)
+                if parts:
+                    yield name, self._finish_sheet(name, parts)
+                continue
+
+            pending: list[DataFrame[ChatSchema]] = []
+            rows = 0
+            chunk = 0
+            for df in dataframes:
+                pending.append(df)
+                rows += len(df)
+                if rows < chunk_rows:
+                    continue
+                combined = pd.concat(pending, ignore_index=True)
+                start = 0
+                while rows - start >= chunk_rows:
+                    chunk += 1
+                    yield f"{name}#{chunk}", self._finish_sheet(
+                        name, [combined.iloc[start : start + chunk_rows]]
+                    )
+                    start += chunk_rows
+                # copy so the rows already yielded can be freed
+                pending = [combined.iloc[start:].copy()]
+                rows -= start
+            if rows:
+                chunk += 1
+                yield f"{name}#{chunk}", self._finish_sheet(name, pending)
+
+    def get_chat_sheet(
+        self, file_path: Path, name: str
+    ) -> DataFrame[ChatSchema] | None:
+        """
+        Loads a single chat file as a finished sheet, for callers that get
+        files one at a time instead of as nature folders.
+        """
+        df = Preprocessor.get_chat_df(file_path, self.validation, self.sample_rows)
+        if df is None:
+            return None
+        return self._finish_sheet(name, [df])
+
+    def _chat_folders(self, chat_folder: str) -> dict[str, list[Path]]:
         chat_path = self.base_path / chat_folder
-        subfolders = [f for f in chat_path.iterdir() if f.is_dir()]
-
-        for sub in tqdm(subfolders, desc="Loading CSV fils content", unit="files"):
-            tqdm.write("Reading folder: " + sub.name)
-            dataframes = Preprocessor._get_chat_df_folder(sub)
-            if dataframes:
-                df = Preprocessor._combine_chat(dataframes).reindex(
-                    [
-                        "Source",
-                        "Group",
-                        "Date1",
-                        "Date2",
-                        "Time",
-                        "userPhone",
-                        "quotedMessage",
-                        "messageBody",
-                        "mediaType",
-                        "mediaCaption",
-                        "Reason",
-                    ],
-                    axis=1,
-                )
-                sheets[sub.name] = df
-        return sheets
+        manifest_path = chat_path / DataManager.NATURE_MANIFEST
+        if manifest_path.exists():
+            return Preprocessor._read_nature_manifest(manifest_path)
+        return {f.name: list(f.iterdir()) for f in chat_path.iterdir() if f.is_dir()}
+
+    def _finish_sheet(
+        self, name: str, dataframes: list[DataFrame[ChatSchema]]
+    ) -> DataFrame[ChatSchema]:
+        df = Preprocessor._combine_chat(
+            dataframes, validate=self.validation == "full"
+        ).reindex(
+            [
+                "Source",
+                "Group",
+                "Date1",
+                "Date2",
+                "Time",
+                "userPhone",
+                "quotedMessage",
+                "messageBody",
+                "mediaType",
+                "mediaCaption",
+                "Reason",
+            ],
+            axis=1,
+        )
+        if self.compact:
+            df = Preprocessor.compact_chat_df(df)
+            megabytes = df.memory_usage(deep=True).sum() / 2**20
+            tqdm.write(f"Compacted {name}: {len(df)} rows, {megabytes:.1f} MB")
+        return df
+
+    @staticmethod
+    def compact_chat_df(chat_df: DataFrame[ChatSchema]) -> DataFrame[ChatSchema]:
+        """
+        Converts a validated chat frame to compact dtypes: categoricals for
+        the repeated columns and pyarrow strings for the free text.
+        """
+        dtypes = {col: "category" for col in Preprocessor.CATEGORY_COLUMNS}
+        dtypes.update({col: "string[pyarrow]" for col in Preprocessor.TEXT_COLUMNS})
+        present = {col: dtype for col, dtype in dtypes.items() if col in chat_df}
+        return cast(DataFrame[ChatSchema], chat_df.astype(present))
 
     @staticmethod
-    def _get_chat_df_folder(chat_path: Path) -> list[DataFrame[ChatSchema]]:
-        dataframes: list[DataFrame[ChatSchema]] = []
-        files = chat_path.iterdir()
-        for file in files:
-            df = Preprocessor.get_chat_df(file)
-            if df is not None:
-                dataframes.append(df)
-        return dataframes
+    def _read_nature_manifest(manifest_path: Path) -> dict[str, list[Path]]:
+        manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+        source = manifest_path.parent / manifest["source"]
+        return {
+            nature: [source / file for file in files]
+            for nature, files in manifest["natures"].items()
+        }
+
+    @staticmethod
+    def _iter_chat_df_files(
+        files: list[Path],
+        validation: ValidationPolicy = "full",
+        sample_rows: int = 10_000,
+        workers: int = 1,
+        executor: LoadExecutor = "process",
+    ) -> Iterator[DataFrame[ChatSchema]]:
+        """
+        Loads the chat files in name order. With workers > 1 they are parsed
+        and validated in a pool, still yielded in order, with at most two
+        finished files per worker waiting to be consumed.
+        """
+        files = sorted(
+            f for f in files if f.suffix in Preprocessor.CHAT_SUFFIXES and f.is_file()
+        )
+        if workers <= 1 or len(files) <= 1:
+            for file in files:
+                df = Preprocessor.get_chat_df(file, validation, sample_rows)
+                if df is not None:
+                    yield df
+            return
+
+        pool_class = ProcessPoolExecutor if executor == "process" else ThreadPoolExecutor
+        pool: Executor
+        with pool_class(max_workers=workers) as pool:
+            pending: deque[Future] = deque()
+            try:
+                for file in files:
+                    pending.append(
+                        pool.submit(
+                            Preprocessor.get_chat_df, file, validation, sample_rows
+                        )
+                    )
+                    if len(pending) >= 2 * workers:
+                        df = pending.popleft().result()
+                        if df is not None:
+                            yield df
+                while pending:
+                    df = pending.popleft().result()
+                    if df is not None:
+                        yield df
+            finally:
+                # a failed file or an abandoned iterator stops the queued loads
+                for future in pending:
+                    future.cancel()
 
     @staticmethod
-    def get_chat_df(file_path: Path) -> DataFrame[ChatSchema] | None:
-        df = DataLoader.csv_to_df(file_path)
+    def get_chat_df(
+        file_path: Path,
+        validation: ValidationPolicy = "full",
+        sample_rows: int = 10_000,
+    ) -> DataFrame[ChatSchema] | None:
+        if file_path.suffix == ".parquet":
+            df = DataLoader.parquet_to_df(
+                file_path, columns=list(ChatSchemaRaw.to_schema().columns)
+            )
+        else:
+            # as text like the Parquet output, so userPhone keeps leading zeros
+            df = DataLoader.csv_to_df(file_path, dtype=str)
+        chat = None
         if df is not None:
-            chat = ChatSchemaRaw.validate(df.fillna(""))
+            chat = Preprocessor._validate(
+                ChatSchemaRaw, df.fillna(""), file_path, validation, sample_rows
+            )
 
         if chat is not None:
-            chat["Source"] = file_path.name.replace(".csv", "")
+            chat["Source"] = file_path.stem
             chat["Group"] = ""
             chat["Reason"] = ""
-            validated_chat = ChatSchema.validate(chat)
+            if validation != "full":
+                # the added columns are constants, valid by construction
+                return cast(DataFrame[ChatSchema], chat)
+            validated_chat = Preprocessor._validate(
+                ChatSchema, chat, file_path, validation, sample_rows
+            )
             return validated_chat
 
         return None
 
+    @staticmethod
+    def _validate(
+        schema: type[pa.DataFrameModel],
+        df: pd.DataFrame,
+        file_path: Path,
+        validation: ValidationPolicy,
+        sample_rows: int,
+    ) -> pd.DataFrame:
+        """
+        Validates df with schema under the given policy. Failures are raised
+        as one ValueError naming the file and the offending rows.
+        """
+        try:
+            if validation == "schema":
+                with config_context(validation_depth=ValidationDepth.SCHEMA_ONLY):
+                    return schema.validate(df, lazy=True)
+            if validation == "sampled" and len(df) > sample_rows:
+                # coercion still applies to every row, only the checks are sampled
+                return schema.validate(
+                    df, sample=sample_rows, random_state=0, lazy=True
+                )
+            return schema.validate(df, lazy=True)
+        except pa.errors.SchemaErrors as e:
+            raise ValueError(Preprocessor._describe_errors(file_path, e)) from e
+
+    @staticmethod
+    def _describe_errors(
+        file_path: Path, error: pa.errors.SchemaErrors, limit: int = 20
+    ) -> str:
+        cases = error.failure_cases
+        lines = [f"Validation of {file_path} failed ({len(cases)} problems):"]
+        for case in cases.head(limit).itertuples(index=False):
+            if pd.isna(case.index):
+                # schema level, e.g. a missing column
+                lines.append(f"  {case.check}: {case.failure_case!r}")
+                continue
+            # counted in records from 1, a quoted message can span several
+            # CSV lines so the line number would not match
+            lines.append(
+                f"  data row {int(case.index) + 1}, column '{case.column}': {case.check} "
+                f"(value: {case.failure_case!r})"
+            )
+        if len(cases) > limit:
+            lines.append(f"  ... and {len(cases) - limit} more")
+        return "\n".join(lines)
+
     @staticmethod
     def _combine_chat(
         dataframes: list[DataFrame[ChatSchema]],
+        validate: bool = True,
     ) -> DataFrame[ChatSchema]:
         combined = pd.concat(dataframes, ignore_index=True)
+        if not validate:
+            # every part was validated on load
+            return cast(DataFrame[ChatSchema], combined)
         validated_df = ChatSchema.validate(combined)
         return validated_df
\ No newline at end of file
@@ -0,0 +1,13 @@
+# markers passed through the asyncio queues of the scheduler and the pipeline
+
+# end of the items of a queue
+STOP = object()
+
+
+class Failure:
+    """
+    Error raised by a producer or worker, carried to the consumer to re-raise.
+    """
+
+    def __init__(self, error: BaseException) -> None:
+        self.error = error
@@ -0,0 +1,184 @@
+import asyncio
+import random
+import time
+from typing import Literal
+
+from openai import (APIConnectionError, APIStatusError, APITimeoutError,
+                    RateLimitError)
+
+from utils.limiter import AdaptiveLimiter
+
+ErrorClass = Literal[
+    "rate_limit", "server", "timeout", "connection", "client", "validation"
+]
+
+# errors that say the provider is unhealthy rather than the request is bad
+TRANSIENT: set[str] = {"server", "timeout", "connection"}
+
+
+class ProviderError(Exception):
+    """
+    Failed provider call, classified so callers can decide how to retry.
+    """
+
+    def __init__(
+        self, error_class: ErrorClass, message: str, retry_after: float | None = None
+    ) -> None:
+        super().__init__(message)
+        self.error_class = error_class
+        self.retry_after = retry_after
+
+    @classmethod
+    def from_exception(cls, e: Exception) -> "ProviderError":
+        if isinstance(e, RateLimitError):
+            retry_after = AdaptiveLimiter.parse_retry_after(e.response.headers)
+            return cls("rate_limit", f"RateLimitError: {e}", retry_after)
+        if isinstance(e, APIStatusError):
+            if e.status_code in (408, 504):
+                return cls("timeout", f"APIStatusError: {e}")
+            if e.status_code >= 500:
+                return cls("server", f"APIStatusError: {e}")
+            return cls("client", f"APIStatusError: {e}")
+        if isinstance(e, APITimeoutError):
+            return cls("timeout", f"APITimeoutError: {e}")
+        if isinstance(e, APIConnectionError):
+            return cls("connection", f"APIConnectionError: {e}")
+        return cls("client", f"{type(e).__name__}: {e}")
+
+
+class LLMRequestError(Exception):
+    """
+    Final failure of a request after the retry policy gave up.
+    """
+
+    def __init__(self, error_class: ErrorClass, message: str) -> None:
+        super().__init__(message)
+        self.error_class = error_class
+
+
+class RetryPolicy:
+    """
+    Per error class attempt limits and jittered exponential backoff.
+    """
+
+    # error class -> (max attempts, base delay, max delay) in seconds
+    DEFAULTS: dict[str, tuple[int, float, float]] = {
+        "rate_limit": (6, 2.0, 60.0),
+        "server": (4, 1.0, 30.0),
+        "timeout": (4, 1.0, 30.0),
+        "connection": (4, 1.0, 30.0),
+        "client": (1, 0.0, 0.0),
+        "validation": (3, 0.0, 0.0),
+    }
+
+    def __init__(
+        self, overrides: dict[str, tuple[int, float, float]] | None = None
+    ) -> None:
+        self.rules = {**self.DEFAULTS, **(overrides or {})}
+
+    def max_attempts(self, error_class: str) -> int:
+        return self.rules[error_class][0]
+
+    def delay(
+        self, error_class: str, attempt: int, retry_after: float | None = None
+    ) -> float:
+        """
+        Full-jitter backoff for the given attempt (1 based), never shorter
+        than the provider's Retry-After.
+        """
+        _, base, cap = self.rules[error_class]
+        delay = random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+        return max(delay, retry_after or 0.0)
+
+
+class CircuitBreaker:
+    """
+    Pauses dispatch after a run of consecutive transient failures. Once the
+    cooldown is over a single probe request is let through; its success
+    closes the breaker, its failure re-opens it with a doubled cooldown.
+    Results of requests sent before the breaker opened do not affect it.
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = 20,
+        cooldown: float = 15.0,
+        max_cooldown: float = 300.0,
+    ) -> None:
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.cooldown = cooldown
+        self.state: Literal["closed", "open", "half_open"] = "closed"
+        # closed -> open transitions
+        self.trips = 0
+        self._failures = 0
+        self._open_until = 0.0
+        # token of the probe in flight, 0 if none
+        self._probe = 0
+        self._probes = 0
+
+    async def wait(self) -> int:
+        """
+        Waits until a request may be sent. Returns a probe token, 0 for an
+        ordinary request, to pass to record_success / record_failure and to
+        end_probe once the request is over.
+        """
+        while True:
+            if self.state == "closed":
+                return 0
+            now = time.monotonic()
+            if self.state == "open" and now >= self._open_until:
+                self.state = "half_open"
+            if self.state == "half_open" and not self._probe:
+                self._probes += 1
+                self._probe = self._probes
+                return self._probe
+            await asyncio.sleep(max(0.5, self._open_until - now))
+
+    def end_probe(self, probe: int) -> None:
+        """
+        Lets another request probe if this one ended without a result,
+        e.g. cancelled or failed with an unclassified error.
+        """
+        if probe and probe == self._probe:
+            self._probe = 0
+
+    def record_success(self, probe: int = 0) -> None:
+        if self.state == "closed":
+            self._failures = 0
+            return
+        if probe and probe == self._probe:
+            self._close()
+
+    def record_failure(self, error_class: str, probe: int = 0) -> None:
+        if self.state != "closed":
+            # only the probe decides how a paused breaker goes on
+            if not probe or probe != self._probe:
+                return
+            if error_class in TRANSIENT:
+                self._open(min(self.max_cooldown, self.cooldown * 2))
+            else:
+                # the provider answered, only the request was bad
+                self._close()
+            return
+
+        if error_class not in TRANSIENT:
+            return
+        self._failures += 1
+        if self._failures >= self.failure_threshold:
+            self.trips += 1
+            self._open(self.cooldown)
+
+    def _close(self) -> None:
+        self._failures = 0
+        self._probe = 0
+        self.cooldown = self.base_cooldown
+        self.state = "closed"
+
+    def _open(self, cooldown: float) -> None:
+        self.cooldown = cooldown
+        self.state = "open"
+        self._probe = 0
+        self._open_until = time.monotonic() + cooldown
+        print(f"Circuit breaker open: provider unhealthy, pausing dispatch for {cooldown:.0f}s")
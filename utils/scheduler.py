@@ -0,0 +1,67 @@
+import asyncio
+from typing import AsyncIterator, Awaitable, Callable, Iterable, TypeVar
+
+from utils.queues import STOP, Failure
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class TaskScheduler:
+    """
+    Runs an async function over items with a fixed pool of workers. Items are
+    pulled lazily through a bounded queue, so only about `workers` items are
+    in flight (plus `queue_size` waiting) however many the iterable yields.
+    """
+
+    def __init__(self, workers: int = 400, queue_size: int | None = None) -> None:
+        self.workers = max(1, workers)
+        self.queue_size = queue_size or self.workers
+
+    async def map(
+        self, func: Callable[[T], Awaitable[R]], items: Iterable[T]
+    ) -> AsyncIterator[R]:
+        """
+        Yields func(item) for every item in completion order.
+        """
+        todo: asyncio.Queue = asyncio.Queue(self.queue_size)
+        done: asyncio.Queue = asyncio.Queue(self.queue_size)
+
+        async def feed() -> None:
+            try:
+                for item in items:
+                    await todo.put(item)
+            except Exception as e:
+                await done.put(Failure(e))
+            for _ in range(self.workers):
+                await todo.put(STOP)
+
+        async def work() -> None:
+            while True:
+                item = await todo.get()
+                if item is STOP:
+                    break
+                try:
+                    result = await func(item)
+                except Exception as e:
+                    await done.put(Failure(e))
+                    break
+                await done.put(result)
+            await done.put(STOP)
+
+        tasks = [asyncio.create_task(feed())]
+        tasks += [asyncio.create_task(work()) for _ in range(self.workers)]
+        try:
+            finished = 0
+            while finished < self.workers:
+                result = await done.get()
+                if result is STOP:
+                    finished += 1
+                elif isinstance(result, Failure):
+                    raise result.error
+                else:
+                    yield result
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
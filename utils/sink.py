@@ -0,0 +1,171 @@
+import json
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from openpyxl import Workbook
+
+
+class ResultSink(ABC):
+    """
+    Writes processed sheets to an output file one at a time, so the whole
+    result never has to be held in memory. Output goes to a temporary file
+    that replaces the target only when the sink is closed without error.
+    """
+
+    def __init__(self, path: str | Path) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.tmp_path = self.path.with_name(self.path.name + ".tmp")
+        # left behind by a killed run
+        self.tmp_path.unlink(missing_ok=True)
+        self.rows = 0
+        self.columns: list[str] | None = None
+
+    def __enter__(self) -> "ResultSink":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, sheet: str, df: pd.DataFrame) -> None:
+        # every sheet is written with the columns of the first one
+        if self.columns is None:
+            self.columns = list(df.columns)
+        self._write(sheet, df.reindex(columns=self.columns))
+        self.rows += len(df)
+
+    @abstractmethod
+    def _write(self, sheet: str, df: pd.DataFrame) -> None: ...
+
+    def _finish(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self._finish()
+        if self.tmp_path.exists():
+            self.tmp_path.replace(self.path)
+
+    def abort(self) -> None:
+        try:
+            self._finish()
+        finally:
+            self.tmp_path.unlink(missing_ok=True)
+
+
+class CsvSink(ResultSink):
+
+    def _write(self, sheet: str, df: pd.DataFrame) -> None:
+        header = not self.tmp_path.exists()
+        df.to_csv(self.tmp_path, mode="a", header=header, index=False, encoding="utf-8")
+
+
+class JsonlSink(ResultSink):
+
+    def __init__(self, path: str | Path) -> None:
+        super().__init__(path)
+        self._file = open(self.tmp_path, "w", encoding="utf-8")
+
+    def _write(self, sheet: str, df: pd.DataFrame) -> None:
+        records = df.astype(object).where(df.notna(), None).to_dict(orient="records")
+        for record in records:
+            self._file.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+
+    def _finish(self) -> None:
+        self._file.close()
+
+
+class ParquetSink(ResultSink):
+
+    def __init__(self, path: str | Path) -> None:
+        super().__init__(path)
+        self._writer: pq.ParquetWriter | None = None
+
+    def _write(self, sheet: str, df: pd.DataFrame) -> None:
+        # everything is stored as text so sheets with all-empty columns
+        # still match the schema of the first one
+        table = pa.Table.from_pandas(df.astype("string"), preserve_index=False)
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self.tmp_path, table.schema)
+        self._writer.write_table(table.cast(self._writer.schema))
+
+    def _finish(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+
+
+class ExcelSink(ResultSink):
+    """
+    Streams rows into a write-only openpyxl workbook. Sheets longer than
+    Excel's row limit continue on "<name> (2)", "<name> (3)", ...
+    With sheet_per_name=False all sheets are appended to one "Sheet1".
+    """
+
+    MAX_ROWS = 1_048_576
+
+    def __init__(self, path: str | Path, sheet_per_name: bool = True) -> None:
+        super().__init__(path)
+        self.sheet_per_name = sheet_per_name
+        self._workbook = Workbook(write_only=True)
+        self._sheets: dict[str, list] = {}
+
+    def _worksheet(self, name: str):
+        # [current worksheet, rows in it, parts]
+        state = self._sheets.get(name)
+        if state is None or state[1] >= self.MAX_ROWS:
+            part = 1 if state is None else state[2] + 1
+            title = name if part == 1 else f"{name[:25]} ({part})"
+            worksheet = self._workbook.create_sheet(title=title[:31])
+            worksheet.append(self.columns)
+            state = self._sheets[name] = [worksheet, 1, part]
+        return state
+
+    def _write(self, sheet: str, df: pd.DataFrame) -> None:
+        name = (sheet or "Sheet1") if self.sheet_per_name else "Sheet1"
+        self._worksheet(name)
+        values = df.astype(object).where(df.notna(), None)
+        for row in values.itertuples(index=False, name=None):
+            state = self._worksheet(name)
+            state[0].append(row)
+            state[1] += 1
+
+    def _finish(self) -> None:
+        if not self._sheets:
+            self._workbook.create_sheet(title="Sheet1")
+        self._workbook.save(self.tmp_path)
+
+
+def open_sink(path: str | Path, sheet_per_name: bool = True) -> ResultSink:
+    """
+    Picks the sink from the file extension: .xlsx, .csv, .jsonl or .parquet.
+    """
+    suffix = Path(path).suffix.lower()
+    if suffix == ".csv":
+        return CsvSink(path)
+    if suffix == ".jsonl":
+        return JsonlSink(path)
+    if suffix == ".parquet":
+        return ParquetSink(path)
+    if suffix == ".xlsx":
+        return ExcelSink(path, sheet_per_name=sheet_per_name)
+    raise ValueError(f"Unsupported output format: {suffix}")
+
+
+def read_results(path: str | Path) -> pd.DataFrame:
+    """
+    Reads back an output written by a sink, all sheets concatenated.
+    """
+    suffix = Path(path).suffix.lower()
+    if suffix == ".csv":
+        return pd.read_csv(path, dtype=str)
+    if suffix == ".jsonl":
+        return pd.read_json(path, lines=True, dtype=False, convert_dates=False)
+    if suffix == ".parquet":
+        return pd.read_parquet(path)
+    sheets = pd.read_excel(path, sheet_name=None, dtype=str)
+    return pd.concat(sheets.values(), ignore_index=True)
@@ -0,0 +1,137 @@
+from typing import Iterable, NamedTuple, cast
+
+from pandera.typing import DataFrame
+
+from utils.validator import KeywordRow, KeywordSchema
+
+
+class AhoCorasick:
+    """
+    Multi-pattern string matcher. Every pattern is found in a single pass over
+    the text, including overlapping ones (e.g. "a2" inside "a2 gold").
+    """
+
+    def __init__(self, patterns: Iterable[str]) -> None:
+        self.patterns: list[str] = []
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._out: list[frozenset[int]] = [frozenset()]
+
+        outputs: list[set[int]] = [set()]
+        for pattern in patterns:
+            pattern_id = len(self.patterns)
+            self.patterns.append(pattern)
+            state = 0
+            for ch in pattern:
+                nxt = self._goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    outputs.append(set())
+                state = nxt
+            outputs[state].add(pattern_id)
+
+        # breadth-first pass to set failure links and inherit their outputs
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0)
+                outputs[nxt] |= outputs[self._fail[nxt]]
+
+        self._out = [frozenset(o) for o in outputs]
+
+    def find(self, text: str) -> set[int]:
+        """
+        Returns the ids of all patterns occurring in text.
+        """
+        goto, fail, out = self._goto, self._fail, self._out
+        found: set[int] = set()
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                found |= out[state]
+        return found
+
+
+class KeywordRule(NamedTuple):
+    header: str
+    keyword: int
+    required: tuple[int, ...]
+
+
+class KeywordTagger:
+    """
+    Compiles the whole keyword frame into one automaton and tags every message
+    with all of its headers in a single scan. Matching is case-insensitive.
+    """
+
+    def __init__(self, keyword_df: DataFrame[KeywordSchema]) -> None:
+        headers = list(keyword_df["headers"].unique())
+        self.generic_headers = [h for h in headers if "generic" in h]
+        self.non_generic_headers = [h for h in headers if "generic" not in h]
+        # generic header -> sub-brand headers that take precedence over it
+        self.subbrands: dict[str, list[str]] = {
+            g: [h for h in self.non_generic_headers if g.replace("_generic", "") in h]
+            for g in self.generic_headers
+        }
+
+        pattern_ids: dict[str, int] = {}
+
+        def pattern_id(word: str) -> int:
+            return pattern_ids.setdefault(word.lower(), len(pattern_ids))
+
+        # keyword pattern id -> rules triggered by it
+        self.rules: dict[int, list[KeywordRule]] = {}
+        for row in cast(list[KeywordRow], keyword_df.itertuples(index=False)):
+            if not row.keyword:
+                continue
+            # required_keyword holds "|"-separated alternatives
+            required = tuple(
+                pattern_id(word)
+                for word in (row.required_keyword or "").split("|")
+                if word
+            )
+            rule = KeywordRule(row.headers, pattern_id(row.keyword), required)
+            self.rules.setdefault(rule.keyword, []).append(rule)
+
+        self.automaton = AhoCorasick(pattern_ids)
+
+    def tag_message(self, message: str) -> set[str]:
+        """
+        Returns the headers hit by message, with generic headers skipped when
+        one of their sub-brands is hit.
+        """
+        found = self.automaton.find(str(message).lower())
+        if not found:
+            return set()
+
+        hits: set[str] = set()
+        for keyword in found:
+            for rule in self.rules.get(keyword, ()):
+                if not rule.required or not found.isdisjoint(rule.required):
+                    hits.add(rule.header)
+
+        for generic, subbrands in self.subbrands.items():
+            if generic in hits and any(sub in hits for sub in subbrands):
+                hits.discard(generic)
+        return hits
+
+    def tag(self, messages: Iterable[str]) -> dict[str, list[int]]:
+        """
+        Scans every message once and returns header -> positions of the
+        messages hitting it.
+        """
+        positions: dict[str, list[int]] = {}
+        for pos, message in enumerate(messages):
+            for header in self.tag_message(message):
+                positions.setdefault(header, []).append(pos)
+        return positions
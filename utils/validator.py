@@ -1,7 +1,7 @@
 from typing import Literal, NamedTuple
 
 import pandera.pandas as pa
-from pydantic import BaseModel
+from pydantic import BaseModel, RootModel, model_validator
 
 
 class KeywordSchemaRaw(pa.DataFrameModel):
@@ -38,6 +38,7 @@ class KeywordRow(NamedTuple):
     product: str
     keyword: str
     required_product: str | None
+    headers: str
     required_keyword: str | None
 
 
@@ -58,5 +59,31 @@ class ChatRow(NamedTuple):
 
 class SentimentResponse(BaseModel):
     success: bool
+    # failed requests carry no sentiment, only the error class
+    sentiment: Literal["P", "N", "I"] | None = None
+    reason: str
+    error: str | None = None
+
+    @model_validator(mode="after")
+    def check_sentiment(self) -> "SentimentResponse":
+        if self.success and self.sentiment is None:
+            raise ValueError("sentiment is required")
+        return self
+
+
+class BatchSentimentItem(SentimentResponse):
+    id: int
+
+
+class BatchSentimentResponse(RootModel[list[BatchSentimentItem]]):
+    pass
+
+
+class BrandSentiment(BaseModel):
     sentiment: Literal["P", "N", "I"]
-    reason: str
\ No newline at end of file
+    reason: str
+
+
+class MultiSentimentResponse(BaseModel):
+    success: bool
+    results: dict[str, BrandSentiment]
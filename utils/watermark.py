@@ -0,0 +1,149 @@
+import hashlib
+import json
+from pathlib import Path
+
+import pandas as pd
+
+from utils.chatprocessor import FAILED_STATUS
+from utils.journal import ResultJournal
+from utils.keywords import KeywordIndex
+from utils.sink import read_results
+
+
+class WatermarkStore:
+    """
+    Per-group high-water mark of the last completed run: the latest Date2 +
+    Time analyzed and the fingerprints of the rows at that instant. Together
+    with the previous output it lets a run send only the newer rows.
+    """
+
+    def __init__(
+        self,
+        path: str | Path,
+        keyword_index: KeywordIndex,
+        previous: pd.DataFrame | None = None,
+    ) -> None:
+        self.path = Path(path)
+        # marks of another keyword set would skip rows it never tagged
+        self.keywords = hashlib.sha1(
+            keyword_index.prompt_keywords.encode("utf-8")
+        ).hexdigest()
+        # group -> {"timestamp": iso timestamp, "fingerprints": [row keys]}
+        # marks loaded from the last run, read by split and left as they are
+        self.marks: dict[str, dict] = {}
+        # marks of the groups this run has analyzed, merged in by save
+        self._pending: dict[str, dict] = {}
+        # previous output indexed by row key
+        self.previous: pd.DataFrame | None = None
+        self.reused = 0
+
+        headers = keyword_index.unique_headers
+        if previous is not None and set(headers) <= set(previous.columns):
+            keys = ResultJournal.row_keys(previous)
+            unique = ~keys.duplicated()
+            self.previous = previous[unique].set_axis(keys[unique])
+            # rows that failed last time are sent again
+            self._failed = self.previous.index[
+                (self.previous[headers] == FAILED_STATUS).any(axis=1)
+            ]
+            self._load(set(previous["Source"].astype(str)))
+
+    def _load(self, groups: set[str]) -> None:
+        try:
+            data = json.loads(self.path.read_text(encoding="utf-8"))
+        except (OSError, json.JSONDecodeError):
+            return
+        if data.get("keywords") != self.keywords:
+            return
+        # a mark is only usable if the rows behind it are in the previous output
+        self.marks = {g: m for g, m in data["groups"].items() if g in groups}
+
+    @staticmethod
+    def read_output(path: str | Path) -> pd.DataFrame | None:
+        """
+        Reads the saved analysis output of the previous run, if there is one.
+        """
+        path = Path(path)
+        if not path.exists():
+            return None
+        return read_results(path).fillna("").astype(str)
+
+    @staticmethod
+    def timestamps(chat_df: pd.DataFrame) -> pd.Series:
+        # as text, compact frames hold Date2 / Time as categoricals
+        return pd.to_datetime(
+            chat_df["Date2"].astype(str), dayfirst=True, errors="coerce"
+        ) + pd.to_timedelta(chat_df["Time"].astype(str), errors="coerce")
+
+    def split(self, chat_df: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame]:
+        """
+        Splits a sheet into the rows past their group's watermark, which
+        still need analysis, and the previous results of all other rows.
+        Both keep the index of chat_df.
+        """
+        if self.previous is None or not self.marks:
+            return chat_df, chat_df.iloc[0:0]
+
+        keys = ResultJournal.row_keys(chat_df)
+        stamps = self.timestamps(chat_df)
+        sources = chat_df["Source"].astype(str)
+        mark_stamps = pd.to_datetime(
+            sources.map(lambda g: self.marks.get(g, {}).get("timestamp"))
+        )
+        seen = {fp for mark in self.marks.values() for fp in mark["fingerprints"]}
+
+        fresh = (
+            mark_stamps.isna()
+            | stamps.isna()
+            | (stamps > mark_stamps)
+            | ((stamps == mark_stamps) & ~keys.isin(seen))
+            | keys.isin(self._failed)
+            | ~keys.isin(self.previous.index)
+        ).to_numpy()
+
+        reused = self.previous.loc[keys[~fresh]].set_axis(chat_df.index[~fresh])
+        self.reused += len(reused)
+        return chat_df[fresh].copy(), reused
+
+    def advance(self, result_df: pd.DataFrame) -> None:
+        """
+        Moves the pending mark of every group in result_df to its latest row.
+        A group split over several chunks keeps the latest mark of this run.
+        """
+        if result_df.empty:
+            return
+        frame = pd.DataFrame(
+            {
+                "group": result_df["Source"].astype(str).to_numpy(),
+                "stamp": self.timestamps(result_df).to_numpy(),
+                "key": ResultJournal.row_keys(result_df).to_numpy(),
+            }
+        ).dropna(subset=["stamp"])
+        latest = frame.groupby("group")["stamp"].transform("max")
+        at_latest = frame[frame["stamp"] == latest]
+        for group, rows in at_latest.groupby("group"):
+            group = str(group)
+            stamp = rows["stamp"].iloc[0]
+            fingerprints = set(rows["key"])
+            mark = self._pending.get(group)
+            if mark is not None:
+                marked = pd.Timestamp(mark["timestamp"])
+                if marked > stamp:
+                    continue
+                if marked == stamp:
+                    fingerprints |= set(mark["fingerprints"])
+            self._pending[group] = {
+                "timestamp": stamp.isoformat(),
+                "fingerprints": sorted(fingerprints),
+            }
+
+    def save(self) -> None:
+        # groups this run did not see keep their loaded mark
+        groups = {**self.marks, **self._pending}
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(".tmp")
+        tmp_path.write_text(
+            json.dumps({"keywords": self.keywords, "groups": groups}),
+            encoding="utf-8",
+        )
+        tmp_path.replace(self.path)